@@ -0,0 +1,159 @@
+import hashlib
+import json
+import os
+
+import faiss
+import numpy as np
+
+# faiss.index_factory descriptions of the supported index types
+INDEX_TYPES = {
+    "flat": "Flat",
+    "ivf_flat": "IVF{nlist},Flat",
+    "ivf_pq": "IVF{nlist},PQ{pq_m}",
+    "hnsw": "HNSW{hnsw_m}",
+    "opq_ivf_pq": "OPQ{pq_m},IVF{nlist},PQ{pq_m}",
+}
+
+
+def default_nlist(num_docs):
+    # ~4 sqrt(N) lists, a power of two, with at least 39 training points per list
+    nlist = 1 << int(np.log2(max(4 * np.sqrt(num_docs), 1)))
+    return int(max(1, min(nlist, num_docs // 39)))
+
+
+def index_description(index_type, num_docs, nlist=None, pq_m=64, hnsw_m=32):
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type {index_type!r}, expected one of {list(INDEX_TYPES)}")
+    return INDEX_TYPES[index_type].format(
+        nlist=nlist or default_nlist(num_docs), pq_m=pq_m, hnsw_m=hnsw_m
+    )
+
+
+def read_block(embeddings, rows, normalize):
+    block = np.array(embeddings[rows], dtype=np.float32)
+    if normalize:
+        faiss.normalize_L2(block)
+    return block
+
+
+def training_sample(embeddings, size, normalize=True, seed=0):
+    """
+    Returns a uniform random sample of size rows (all rows if fewer), read in
+    row order so a memmap is scanned front to back.
+    """
+    if size >= len(embeddings):
+        return read_block(embeddings, slice(None), normalize)
+    rows = np.sort(np.random.default_rng(seed).choice(len(embeddings), size, replace=False))
+    return read_block(embeddings, rows, normalize)
+
+
+def build_index(
+    embeddings,
+    index_type="flat",
+    nlist=None,
+    pq_m=64,
+    hnsw_m=32,
+    train_size=None,
+    normalize=True,
+    add_block_size=65536,
+    seed=0,
+):
+    """
+    Builds an inner-product index over embeddings (an array or memmap of
+    shape (num_docs, dim)), adding it one block at a time.
+
+    IVF and PQ indexes are trained on train_size sampled rows, by default
+    256 per IVF list (clustering quality barely improves past that) and at
+    least 2^14 for the PQ codebooks. With normalize, rows are L2-normalized
+    so inner product is cosine similarity.
+    """
+    num_docs, dim = embeddings.shape
+    description = index_description(index_type, num_docs, nlist, pq_m, hnsw_m)
+    index = faiss.index_factory(dim, description, faiss.METRIC_INNER_PRODUCT)
+
+    if not index.is_trained:
+        train_size = train_size or max(256 * (nlist or default_nlist(num_docs)), 1 << 14)
+        sample = training_sample(embeddings, train_size, normalize, seed)
+        print(f"Training {description} on {len(sample)} vectors...")
+        index.train(sample)
+
+    for start in range(0, num_docs, add_block_size):
+        index.add(read_block(embeddings, slice(start, start + add_block_size), normalize))
+    print(f"{description} index contains {index.ntotal} embeddings.")
+    return index
+
+
+def set_search_params(index, nprobe=None, ef_search=None):
+    # ParameterSpace also reaches the IVF/HNSW index inside an OPQ transform
+    params = faiss.ParameterSpace()
+    if nprobe is not None:
+        params.set_index_parameter(index, "nprobe", nprobe)
+    if ef_search is not None:
+        params.set_index_parameter(index, "efSearch", ef_search)
+
+
+def index_manifest(index_type, index_params, normalize, num_docs, **fingerprint):
+    """
+    Describes what a persisted index was built from. fingerprint holds what
+    identifies the embeddings: model hash, pooling, precision, doc ids...
+    """
+    return dict(
+        fingerprint,
+        index_type=index_type,
+        index_params=index_params,
+        normalize=normalize,
+        num_docs=num_docs,
+        faiss_version=faiss.__version__,
+    )
+
+
+def index_file_name(manifest):
+    # Named after the manifest, so indexes built from other embeddings or
+    # settings (another precision, model or document set) get their own file
+    # instead of overwriting each other
+    digest = hashlib.sha1(json.dumps(manifest, sort_keys=True).encode("utf-8")).hexdigest()
+    return f"index_{manifest['index_type']}_{digest[:16]}.faiss"
+
+
+def save_index(index, path, manifest=None):
+    # Drop the old manifest first and write the new one last, so a crash
+    # leaves an index that is rebuilt rather than one that is trusted
+    manifest_path = f"{path}.json"
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    # Write to a temporary file and rename, so a crash never leaves half an index
+    faiss.write_index(index, f"{path}.tmp")
+    os.replace(f"{path}.tmp", path)
+    if manifest is not None:
+        with open(f"{manifest_path}.tmp", "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(f"{manifest_path}.tmp", manifest_path)
+
+
+def load_index(path, mmap=False, index_type="flat"):
+    """
+    Reads an index. With mmap, the vectors stay in the file and are paged
+    in on demand, so loading is near instant and processes searching the
+    same file share its pages through the page cache. IVF indexes map
+    their inverted lists (IO_FLAG_MMAP), flat and HNSW storage maps its
+    codes (IO_FLAG_MMAP_IFC); faiss rejects the two flags combined.
+    """
+    if not mmap:
+        return faiss.read_index(path)
+    flags = faiss.IO_FLAG_MMAP if "ivf" in index_type else faiss.IO_FLAG_MMAP_IFC
+    return faiss.read_index(path, flags)
+
+
+def load_valid_index(path, manifest, mmap=True):
+    """
+    Returns the index persisted at path if its manifest matches manifest,
+    otherwise None.
+    """
+    manifest_path = f"{path}.json"
+    if not (os.path.isfile(path) and os.path.isfile(manifest_path)):
+        return None
+    with open(manifest_path, "r") as f:
+        if json.load(f) != json.loads(json.dumps(manifest)):
+            print(f"Index at {path} was built from different embeddings, rebuilding")
+            return None
+    return load_index(path, mmap, manifest["index_type"])
@@ -0,0 +1,104 @@
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, Sampler
+
+from token_cache import pad_token_ids
+
+
+class TokenizedDataset(Dataset):
+    # Items are (row, token ids) so batches can be scattered back to corpus order
+    def __init__(self, input_ids, offsets):
+        self.input_ids = input_ids
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        return idx, self.input_ids[self.offsets[idx] : self.offsets[idx + 1]]
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+
+class TokenBudgetBatchSampler(Sampler):
+    """
+    Groups rows of similar token length into batches of at most max_tokens
+    padded tokens (batch size x longest row), longest rows first.
+    """
+
+    def __init__(self, lengths, max_tokens, max_batch_size=None):
+        lengths = np.asarray(lengths)
+        if len(lengths) and lengths.max() > max_tokens:
+            raise ValueError(
+                f"max_tokens={max_tokens} is smaller than the longest row ({lengths.max()})"
+            )
+        order = np.argsort(-lengths, kind="stable")
+
+        self.batches = []
+        batch = []
+        batch_length = 0
+        for idx in order.tolist():
+            if batch and (
+                (len(batch) + 1) * batch_length > max_tokens
+                or (max_batch_size and len(batch) >= max_batch_size)
+            ):
+                self.batches.append(batch)
+                batch = []
+            if not batch:
+                # Rows are sorted, so the first one sets the padded length
+                batch_length = int(lengths[idx])
+            batch.append(idx)
+        if batch:
+            self.batches.append(batch)
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+def collate_token_ids(batch, pad_token_id=0, with_token_type_ids=True):
+    rows, sequences = zip(*batch)
+    features = pad_token_ids(sequences, pad_token_id, with_token_type_ids)
+    return torch.tensor(rows, dtype=torch.long), features
+
+
+class ThroughputMeter:
+    # Tracks docs/sec and the share of padded positions fed to the model
+    def __init__(self):
+        self.docs = 0
+        self.real_tokens = 0
+        self.padded_tokens = 0
+        self.start_time = time.perf_counter()
+        self.elapsed = 0.0
+
+    def update(self, attention_mask):
+        self.add(attention_mask.shape[0], int(attention_mask.sum()), attention_mask.numel())
+
+    def add(self, docs, real_tokens, padded_tokens):
+        self.docs += docs
+        self.real_tokens += real_tokens
+        self.padded_tokens += padded_tokens
+
+    def stop(self):
+        self.elapsed = time.perf_counter() - self.start_time
+
+    @property
+    def docs_per_second(self):
+        return self.docs / max(self.elapsed, 1e-9)
+
+    @property
+    def padding_ratio(self):
+        if not self.padded_tokens:
+            return 0.0
+        return 1 - self.real_tokens / self.padded_tokens
+
+    def __str__(self):
+        return (
+            f"{self.docs} docs, {self.docs_per_second:.1f} docs/sec, "
+            f"padded-token ratio {self.padding_ratio:.1%}"
+        )
@@ -0,0 +1,106 @@
+"""Recall/latency sweep of the ANN index types against the exact flat index.
+
+For every index type and nprobe/efSearch setting, prints the build time,
+the serialized index size, the search latency per query, Recall@1000 (share
+of the flat top 1000 that the index also returns) and nDCG@10 on the qrels.
+
+Usage: python bench_ann.py [doc_embeddings] [query_embeddings] [queries.pkl]
+"""
+
+import pickle
+import sys
+import time
+
+import faiss
+import numpy as np
+import pytrec_eval
+
+from ann_index import build_index, set_search_params
+from embedding_store import open_embeddings
+from run import Run
+
+
+def timed_search(index, queries, top_k):
+    start_time = time.perf_counter()
+    distances, indices = index.search(queries, top_k)
+    return distances, indices, time.perf_counter() - start_time
+
+
+def overlap_recall(indices, exact_indices):
+    recalls = []
+    for found, exact in zip(indices, exact_indices):
+        exact = exact[exact >= 0]
+        recalls.append(len(np.intersect1d(found[found >= 0], exact)) / max(len(exact), 1))
+    return float(np.mean(recalls))
+
+
+if __name__ == "__main__":
+    doc_path = sys.argv[1] if len(sys.argv) > 1 else "doc_embeddings"
+    query_path = sys.argv[2] if len(sys.argv) > 2 else "query_embeddings"
+    queries_path = sys.argv[3] if len(sys.argv) > 3 else "../data/queries.pkl"
+    top_k = 1000
+
+    doc_embeddings, doc_ids, _ = open_embeddings(doc_path)
+    query_embeddings, query_ids, _ = open_embeddings(query_path)
+    query_embeddings = np.array(query_embeddings, dtype=np.float32)
+    faiss.normalize_L2(query_embeddings)
+    with open(queries_path, "rb") as f:
+        queries = pickle.load(f)
+    qrels = {
+        query.query_no: {doc_id: query.get_relevance(doc_id) for doc_id in query.relevant_docs}
+        for query in queries
+        if query.number_of_relevant_docs > 0
+    }
+    evaluator = pytrec_eval.RelevanceEvaluator(qrels, {"ndcg_cut_10"})
+
+    def ndcg_at_10(distances, indices):
+        results = evaluator.evaluate(Run(query_ids, doc_ids, distances, indices).to_dict())
+        return float(np.mean([metrics["ndcg_cut_10"] for metrics in results.values()]))
+
+    dim = doc_embeddings.shape[1]
+    # One 8-bit code per 12 dimensions (64 bytes for 768), else per 8; must divide dim
+    pq_m = dim // 12 if dim % 12 == 0 else dim // 8
+    nprobes = [1, 4, 16, 64, 256]
+    configs = [
+        ("flat", {}, [{}]),
+        ("ivf_flat", {}, [{"nprobe": nprobe} for nprobe in nprobes]),
+        ("ivf_pq", {"pq_m": pq_m}, [{"nprobe": nprobe} for nprobe in nprobes]),
+        ("opq_ivf_pq", {"pq_m": pq_m}, [{"nprobe": nprobe} for nprobe in nprobes]),
+        ("hnsw", {}, [{"ef_search": ef} for ef in (64, 256, 1024, 2048)]),
+    ]
+
+    rows = []
+    exact_indices = None
+    for index_type, index_params, sweep in configs:
+        start_time = time.perf_counter()
+        index = build_index(doc_embeddings, index_type, **index_params)
+        build_seconds = time.perf_counter() - start_time
+        size_mb = faiss.serialize_index(index).nbytes / 2**20
+        for search_params in sweep:
+            set_search_params(index, **search_params)
+            distances, indices, seconds = timed_search(index, query_embeddings, top_k)
+            if exact_indices is None:
+                exact_indices = indices
+            setting = ", ".join(f"{key}={value}" for key, value in search_params.items())
+            rows.append(
+                (
+                    index_type,
+                    setting or "-",
+                    build_seconds,
+                    size_mb,
+                    1000 * seconds / len(query_embeddings),
+                    overlap_recall(indices, exact_indices),
+                    ndcg_at_10(distances, indices),
+                )
+            )
+
+    print(f"\n{len(doc_ids)} documents x {dim} dims, {len(query_ids)} queries, top {top_k}")
+    print(
+        f"{'index':<12} {'search':<16} {'build s':>8} {'size MB':>8} "
+        f"{'ms/query':>9} {'R@1000':>7} {'nDCG@10':>8}"
+    )
+    for index_type, setting, build_seconds, size_mb, latency, recall, ndcg in rows:
+        print(
+            f"{index_type:<12} {setting:<16} {build_seconds:>8.1f} {size_mb:>8.1f} "
+            f"{latency:>9.2f} {recall:>7.4f} {ndcg:>8.4f}"
+        )
@@ -0,0 +1,74 @@
+"""CPU throughput and padding of fixed-size batches against token-budget batches.
+
+Usage: python bench_batching.py [num_docs] [model_name] [docstore_path]
+"""
+
+import sys
+
+import numpy as np
+import torch
+from torch.utils.data import BatchSampler, DataLoader, SequentialSampler
+from transformers import AutoModel, AutoTokenizer
+
+from batching import (
+    ThroughputMeter,
+    TokenBudgetBatchSampler,
+    TokenizedDataset,
+    collate_token_ids,
+)
+from docstore import DocumentStore
+from token_cache import tokenize_corpus
+
+
+def run(model, dataset, batch_sampler, collate_fn):
+    loader = DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=collate_fn)
+    embeddings = torch.empty((len(dataset), model.config.hidden_size))
+    meter = ThroughputMeter()
+    with torch.no_grad():
+        for rows, batch in loader:
+            meter.update(batch["attention_mask"])
+            embeddings[rows] = model(**batch).last_hidden_state[:, 0, :]
+    meter.stop()
+    return embeddings, meter
+
+
+if __name__ == "__main__":
+    num_docs = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    model_name = (
+        sys.argv[2] if len(sys.argv) > 2 else "sentence-transformers/msmarco-bert-base-dot-v5"
+    )
+    docstore_path = sys.argv[3] if len(sys.argv) > 3 else "../data/docstore"
+    batch_size = 32
+    max_tokens = batch_size * 512
+
+    docstore = DocumentStore(docstore_path)
+    rows = np.flatnonzero(docstore.present("text"))[:num_docs]
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModel.from_pretrained(model_name).eval()
+
+    input_ids, offsets = tokenize_corpus(
+        (docstore.get(row, "text") for row in rows), tokenizer, max_length=512
+    )
+    dataset = TokenizedDataset(input_ids, offsets)
+
+    def collate_fn(batch):
+        return collate_token_ids(
+            batch, tokenizer.pad_token_id, "token_type_ids" in tokenizer.model_input_names
+        )
+
+    print(f"Documents: {len(dataset)}, threads: {torch.get_num_threads()}")
+    fixed_embeddings, fixed = run(
+        model, dataset, BatchSampler(SequentialSampler(dataset), batch_size, False), collate_fn
+    )
+    print(f"Fixed {batch_size}-doc batches in corpus order: {fixed}")
+    budget_embeddings, budget = run(
+        model, dataset, TokenBudgetBatchSampler(dataset.lengths(), max_tokens), collate_fn
+    )
+    print(f"Token budget of {max_tokens} tokens per batch:  {budget}")
+
+    print(f"Speedup: {budget.docs_per_second / fixed.docs_per_second:.2f}x")
+    # Row order must be preserved even though batches are packed by length
+    print(
+        "Max abs difference between embeddings:",
+        float((fixed_embeddings - budget_embeddings).abs().max()),
+    )
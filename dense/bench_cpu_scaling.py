@@ -0,0 +1,87 @@
+"""Docs/sec of the multi-process CPU engine for each worker x thread split.
+
+Every configuration uses all cores: workers x threads_per_worker = cpu_count.
+One worker with every thread is the single-process baseline; more workers
+with fewer threads each usually win once the per-process thread count
+passes the point where PyTorch's intra-op scaling flattens out.
+
+The curve needs a multi-core host: with a single core, only the 1 x 1
+baseline runs and the script says the curve was not measured.
+
+Usage: python bench_cpu_scaling.py [num_docs] [model_name] [docstore_path]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+from transformers import AutoTokenizer
+
+from cpu_embed import embed_multiprocess
+from docstore import DocumentStore
+from token_cache import load_or_build_token_cache
+
+if __name__ == "__main__":
+    num_docs = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    model_name = (
+        sys.argv[2] if len(sys.argv) > 2 else "sentence-transformers/msmarco-bert-base-dot-v5"
+    )
+    docstore_path = sys.argv[3] if len(sys.argv) > 3 else "../data/docstore"
+    max_tokens = 16384
+    num_cores = os.cpu_count() or 1
+
+    docstore = DocumentStore(docstore_path)
+    rows = np.flatnonzero(docstore.present("text"))[:num_docs]
+    texts = [docstore.get(row, "text") for row in rows]
+    ids = [docstore.get(row, "doc_no") for row in rows]
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        input_ids, offsets = load_or_build_token_cache(
+            texts, tokenizer, 512, os.path.join(work_dir, "token_cache")
+        )
+        splits = [
+            (workers, num_cores // workers)
+            for workers in range(1, num_cores + 1)
+            if num_cores % workers == 0
+        ]
+
+        results = []
+        reference = None
+        for workers, threads in splits:
+            output_path = os.path.join(work_dir, f"embeddings_{workers}")
+            embeddings, meter = embed_multiprocess(
+                model_name,
+                input_ids,
+                offsets,
+                ids,
+                output_path,
+                workers,
+                threads,
+                max_tokens,
+                # Small shards so every configuration checkpoints alike
+                shard_size=256,
+            )
+            results.append((workers, threads, meter.docs_per_second))
+            if reference is None:
+                reference = np.array(embeddings)
+            else:
+                # Every split must produce the same rows in the same order
+                assert np.abs(reference - embeddings).max() < 1e-4
+            shutil.rmtree(output_path)
+
+        baseline = results[0][2]
+        print(f"\n{len(ids)} documents, {num_cores} cores")
+        if len(results) == 1:
+            print("Only one worker x thread split fits this host: scaling curve not measured")
+        print(f"{'workers':>8} {'threads':>8} {'docs/sec':>10} {'speedup':>8}")
+        for workers, threads, docs_per_second in results:
+            print(
+                f"{workers:>8} {threads:>8} {docs_per_second:>10.1f} "
+                f"{docs_per_second / baseline:>7.2f}x"
+            )
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
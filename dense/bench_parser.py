@@ -0,0 +1,87 @@
+"""Per-MB throughput of the regex document tokenizer against the old line-based parser.
+
+Usage: python bench_parser.py [ft_directory] [repeats]
+"""
+
+import os
+import sys
+import time
+from parser import Document, extract_tag_content, iter_file_documents
+
+
+def legacy_iter_file_documents(file_path):
+    # The substring-dispatch parser that iter_file_documents replaced
+    with open(file_path, "r") as file:
+        lines = file.readlines()
+
+    doc = None
+    current_text = []
+    inside_text = False
+    for line in lines:
+        line = line.strip()
+        if "<DOC>" in line:
+            doc = Document()
+        elif "</DOC>" in line and doc:
+            if current_text:
+                doc.text = " ".join(current_text).strip()
+                current_text = []
+            yield doc
+            doc = None
+        elif doc:
+            if "<DOCNO>" in line:
+                doc.doc_no = extract_tag_content([line], "<DOCNO>", "</DOCNO>")
+            elif "<PROFILE>" in line:
+                doc.profile = extract_tag_content([line], "<PROFILE>", "</PROFILE>")
+            elif "<DATE>" in line:
+                doc.date = extract_tag_content([line], "<DATE>", "</DATE>")
+            elif "<HEADLINE>" in line:
+                doc.headline = extract_tag_content([line], "<HEADLINE>", "</HEADLINE>")
+            elif "<TEXT>" in line:
+                inside_text = True
+                current_text.append(extract_tag_content([line], "<TEXT>", "</TEXT>"))
+            elif "</TEXT>" in line:
+                inside_text = False
+            elif inside_text:
+                current_text.append(line)
+            elif "<PUB>" in line:
+                doc.pub = extract_tag_content([line], "<PUB>", "</PUB>")
+            elif "<PAGE>" in line:
+                doc.page = extract_tag_content([line], "<PAGE>", "</PAGE>")
+
+
+def time_parser(parse_file, file_paths, repeats):
+    best = float("inf")
+    num_docs = 0
+    for _ in range(repeats):
+        start = time.perf_counter()
+        num_docs = sum(1 for path in file_paths for _ in parse_file(path))
+        best = min(best, time.perf_counter() - start)
+    return best, num_docs
+
+
+if __name__ == "__main__":
+    doc_path = sys.argv[1] if len(sys.argv) > 1 else "../data/ft/all"
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    file_paths = [
+        os.path.join(doc_path, file_name)
+        for file_name in sorted(os.listdir(doc_path))
+        if os.path.isfile(os.path.join(doc_path, file_name))
+    ]
+    total_mb = sum(os.path.getsize(path) for path in file_paths) / 1024**2
+    print(f"Files: {len(file_paths)}, size: {total_mb:.1f} MB, best of {repeats}")
+
+    # Both parsers must agree on every field the old one did not truncate
+    for path in file_paths[:1]:
+        for old, new in zip(legacy_iter_file_documents(path), iter_file_documents(path)):
+            for field in ("doc_no", "profile", "date", "text", "pub"):
+                if getattr(old, field) != getattr(new, field):
+                    print(f"Mismatch in {old.doc_no}.{field}")
+
+    print(f"{'Parser':<12} {'Docs':>8} {'Seconds':>9} {'MB/s':>8}")
+    for name, parse_file in [
+        ("line-based", legacy_iter_file_documents),
+        ("regex", iter_file_documents),
+    ]:
+        seconds, num_docs = time_parser(parse_file, file_paths, repeats)
+        print(f"{name:<12} {num_docs:>8} {seconds:>9.3f} {total_mb / seconds:>8.1f}")
@@ -0,0 +1,111 @@
+"""Memory held by slotted Document/Query records against the old __dict__ classes.
+
+Usage: python bench_records.py [ft_directory] [qrels_file ...]
+Without qrels files, 150 queries with 1500 judgments each are simulated.
+"""
+
+import random
+import sys
+import tracemalloc
+from parser import Document, Query, iter_documents
+
+
+class LegacyDocument:
+    def __init__(self, doc_no=None, profile=None, date=None, headline=None, text=None, pub=None, page=None):
+        self.doc_no = doc_no
+        self.profile = profile
+        self.date = date
+        self.headline = headline
+        self.text = text
+        self.pub = pub
+        self.page = page
+
+
+class LegacyQuery:
+    def __init__(self, query_no=None, query=None, relevant_docs=None):
+        self.query_no = query_no
+        self.query = query
+        self.number_of_relevant_docs = 0
+        self.relevant_docs = relevant_docs
+
+    def add_relevant_doc(self, doc_no, relevance=1):
+        if self.relevant_docs is None:
+            self.relevant_docs = []
+        self.number_of_relevant_docs += 1
+        self.relevant_docs.append(doc_no)
+
+
+def measure(build):
+    tracemalloc.start()
+    records = build()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return records, current
+
+
+def build_documents(document_class, fields):
+    # Texts are shared between both runs, only the per-record overhead is measured
+    return [document_class(*values) for values in fields]
+
+
+def build_queries(query_class, judgments):
+    queries = {}
+    for query_no, doc_no in judgments:
+        if query_no not in queries:
+            queries[query_no] = query_class(query_no, "topic title")
+        # A fresh string per judgment, as produced by line.split() in parse_relevance
+        queries[query_no].add_relevant_doc("".join(doc_no))
+    return list(queries.values())
+
+
+def read_judgments(qrels_paths):
+    judgments = []
+    for qrels_path in qrels_paths:
+        with open(qrels_path, "r") as file:
+            for line in file:
+                parts = line.split()
+                if len(parts) == 4:
+                    judgments.append((parts[0], parts[2]))
+    return judgments
+
+
+if __name__ == "__main__":
+    doc_path = sys.argv[1] if len(sys.argv) > 1 else "../data/ft/all"
+    qrels_paths = sys.argv[2:]
+
+    fields = [
+        (doc.doc_no, doc.profile, doc.date, doc.headline, doc.text, doc.pub, doc.page)
+        for doc in iter_documents(doc_path)
+    ]
+    if qrels_paths:
+        judgments = read_judgments(qrels_paths)
+    else:
+        random.seed(42)
+        doc_nos = [values[0] for values in fields]
+        judgments = [
+            (str(query_no), doc_no)
+            for query_no in range(301, 451)
+            for doc_no in random.sample(doc_nos, min(1500, len(doc_nos)))
+        ]
+
+    print(f"Documents: {len(fields)}, judgments: {len(judgments)}")
+    print(f"{'Records':<20} {'Legacy MB':>10} {'Slotted MB':>11} {'Reduction':>10}")
+    for name, legacy_build, slotted_build in [
+        (
+            "Document",
+            lambda: build_documents(LegacyDocument, fields),
+            lambda: build_documents(Document, fields),
+        ),
+        (
+            "Query judgments",
+            lambda: build_queries(LegacyQuery, judgments),
+            lambda: build_queries(Query, judgments),
+        ),
+    ]:
+        _, legacy_bytes = measure(legacy_build)
+        # The first slotted run also pays for interning doc_nos in doc_index
+        _, slotted_bytes = measure(slotted_build)
+        print(
+            f"{name:<20} {legacy_bytes / 1024**2:>10.2f} {slotted_bytes / 1024**2:>11.2f}"
+            f" {1 - slotted_bytes / legacy_bytes:>9.0%}"
+        )
@@ -0,0 +1,265 @@
+"""Multi-process CPU embedding engine.
+
+A single PyTorch process stops scaling well past a handful of intra-op
+threads, so on CPU-only nodes the corpus is embedded by several worker
+processes instead, each with its own model replica and a share of the cores
+(torch.set_num_threads). Workers pull token-budget batches from a shared
+queue and write their rows straight into the embeddings.npy of an
+EmbeddingWriter, which every process maps from the same file. The main
+process only tracks which shards are complete and records them in the
+manifest, so an interrupted run resumes like a single-process one.
+
+Scaling has not been measured yet: the docs/s of every workers x threads
+split against the single-process baseline (1 worker with every core) needs
+a multi-core host, where bench_cpu_scaling.py sweeps the grid. Until the
+curve is recorded here, the default is that baseline and multi-worker
+splits are opt-in from the command line.
+
+Usage: python cpu_embed.py [num_workers] [threads_per_worker] [fp32|bf16|int8]
+"""
+
+import multiprocessing
+import os
+import pickle
+import queue
+import sys
+import time
+
+import numpy as np
+import torch
+from tqdm import tqdm
+from transformers import AutoConfig, AutoModel, AutoTokenizer
+
+from batching import ThroughputMeter, TokenBudgetBatchSampler, TokenizedDataset, collate_token_ids
+from docstore import DocumentStore
+from embedding_store import EmbeddingWriter
+from inference import model_fingerprint, prepare_model
+from pooling import load_pooling_modes, pool
+from token_cache import load_or_build_token_cache
+
+
+def default_threads_per_worker(num_workers):
+    return max(1, (os.cpu_count() or 1) // num_workers)
+
+
+def embed_worker(
+    model_name,
+    input_ids_path,
+    offsets_path,
+    embeddings_path,
+    num_threads,
+    precision,
+    pooling_modes,
+    task_queue,
+    result_queue,
+):
+    # One intra-op pool per worker; inter-op parallelism comes from the processes
+    torch.set_num_threads(num_threads)
+    torch.set_num_interop_threads(1)
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = prepare_model(AutoModel.from_pretrained(model_name), precision)
+    with_token_type_ids = "token_type_ids" in tokenizer.model_input_names
+
+    dataset = TokenizedDataset(
+        np.load(input_ids_path, mmap_mode="r"), np.load(offsets_path, mmap_mode="r")
+    )
+    embeddings = np.load(embeddings_path, mmap_mode="r+")
+    result_queue.put(None)
+
+    with torch.no_grad():
+        while True:
+            task = task_queue.get()
+            if task is None:
+                break
+            shard_id, rows = task
+            rows_tensor, features = collate_token_ids(
+                [dataset[row] for row in rows], tokenizer.pad_token_id, with_token_type_ids
+            )
+            output = model(**features).last_hidden_state
+            output = pool(output, features["attention_mask"], pooling_modes)
+            embeddings[rows_tensor.numpy()] = output.float().numpy()
+            attention_mask = features["attention_mask"]
+            result_queue.put(
+                (shard_id, (len(rows), int(attention_mask.sum()), attention_mask.numel()))
+            )
+
+
+def embed_multiprocess(
+    model_name,
+    input_ids,
+    offsets,
+    ids,
+    output_path,
+    num_workers,
+    threads_per_worker=None,
+    max_tokens=65536,
+    max_length=512,
+    shard_size=16384,
+    embedding_dtype="float32",
+    precision="fp32",
+):
+    """
+    Embeds the token cache (input_ids, offsets) into output_path with
+    num_workers processes.
+
+    input_ids and offsets must be memmaps of .npy files (as returned by
+    load_or_build_token_cache), so workers can open them by file name
+    instead of receiving a copy.
+
+    Returns:
+        (embeddings, meter): the EmbeddingWriter's memmap and the
+        ThroughputMeter of the shards computed in this call
+    """
+    threads_per_worker = threads_per_worker or default_threads_per_worker(num_workers)
+    config = AutoConfig.from_pretrained(model_name)
+    pooling_modes = load_pooling_modes(model_name)
+    writer = EmbeddingWriter(
+        output_path,
+        ids,
+        config.hidden_size * len(pooling_modes),
+        embedding_dtype,
+        shard_size,
+        meta={
+            "model": config.name_or_path,
+            "model_hash": model_fingerprint(model_name),
+            "max_length": max_length,
+            "precision": precision,
+            "pooling": list(pooling_modes),
+        },
+    )
+    pending = writer.pending_shards()
+    meter = ThroughputMeter()
+    if not pending:
+        writer.finalize()
+        return writer.embeddings, meter
+
+    # Spawned workers do not inherit the parent's OpenMP state, which makes
+    # forking after torch has run unsafe
+    context = multiprocessing.get_context("spawn")
+    task_queue = context.Queue()
+    result_queue = context.Queue()
+    workers = [
+        context.Process(
+            target=embed_worker,
+            args=(
+                model_name,
+                input_ids.filename,
+                offsets.filename,
+                os.path.join(output_path, "embeddings.npy"),
+                threads_per_worker,
+                precision,
+                pooling_modes,
+                task_queue,
+                result_queue,
+            ),
+            daemon=True,
+        )
+        for _ in range(num_workers)
+    ]
+    for worker in workers:
+        worker.start()
+
+    lengths = np.diff(offsets)
+    remaining = {}
+    num_tasks = 0
+    for shard_id, start, end in pending:
+        remaining[shard_id] = 0
+        for batch in TokenBudgetBatchSampler(lengths[start:end], max_tokens):
+            task_queue.put((shard_id, [start + idx for idx in batch]))
+            remaining[shard_id] += 1
+            num_tasks += 1
+    for _ in workers:
+        task_queue.put(None)
+
+    def get_result():
+        while True:
+            try:
+                return result_queue.get(timeout=5)
+            except queue.Empty:
+                if not all(worker.is_alive() for worker in workers):
+                    raise RuntimeError("An embedding worker exited unexpectedly")
+
+    try:
+        # Time from the moment every replica is loaded
+        for _ in workers:
+            get_result()
+        meter = ThroughputMeter()
+        for _ in tqdm(range(num_tasks), desc=f"Computing {output_path} ({num_workers} workers)"):
+            shard_id, counts = get_result()
+            meter.add(*counts)
+            remaining[shard_id] -= 1
+            if remaining[shard_id] == 0:
+                writer.mark_shard_done(shard_id)
+        meter.stop()
+    finally:
+        for worker in workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+
+    writer.finalize()
+    print(f"Throughput: {meter} ({num_workers} workers x {threads_per_worker} threads)")
+    return writer.embeddings, meter
+
+
+if __name__ == "__main__":
+    # Single-process baseline until bench_cpu_scaling.py has measured a better split
+    num_workers = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    threads_per_worker = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    precision = sys.argv[3] if len(sys.argv) > 3 else "fp32"
+    embedding_suffix = "" if precision == "fp32" else f"_{precision}"
+
+    data_path = "../data"
+    model_name = "sentence-transformers/msmarco-bert-base-dot-v5"
+    max_length = 512
+    max_tokens = 65536
+
+    docstore = DocumentStore(f"{data_path}/docstore")
+    doc_rows = np.flatnonzero(docstore.present("text"))
+    doc_ids = [docstore.get(row, "doc_no") for row in doc_rows]
+    with open(f"{data_path}/queries.pkl", "rb") as f:
+        queries = pickle.load(f)
+
+    class DocumentTexts:
+        # Iterable twice, as load_or_build_token_cache requires
+        def __iter__(self):
+            return (docstore.get(row, "text") for row in doc_rows)
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    token_cache_path = f"{data_path}/token_cache"
+    doc_input_ids, doc_offsets = load_or_build_token_cache(
+        DocumentTexts(), tokenizer, max_length, token_cache_path
+    )
+    query_input_ids, query_offsets = load_or_build_token_cache(
+        [query.query for query in queries], tokenizer, max_length, token_cache_path
+    )
+
+    start_time = time.perf_counter()
+    query_embeddings, _ = embed_multiprocess(
+        model_name,
+        query_input_ids,
+        query_offsets,
+        [query.query_no for query in queries],
+        f"query_embeddings{embedding_suffix}",
+        num_workers,
+        threads_per_worker,
+        max_tokens,
+        max_length,
+        precision=precision,
+    )
+    print("Query Embeddings Shape:", query_embeddings.shape)
+    doc_embeddings, _ = embed_multiprocess(
+        model_name,
+        doc_input_ids,
+        doc_offsets,
+        doc_ids,
+        f"doc_embeddings{embedding_suffix}",
+        num_workers,
+        threads_per_worker,
+        max_tokens,
+        max_length,
+        precision=precision,
+    )
+    print("Document Embeddings Shape:", doc_embeddings.shape)
+    print(f"Total time: {time.perf_counter() - start_time:.1f}s")
@@ -0,0 +1,177 @@
+import json
+import os
+from array import array
+
+import numpy as np
+
+from parser import Document, iter_pickled_documents
+
+# Every column is a contiguous UTF-8 blob plus an int64 offsets array
+COLUMNS = ("doc_no", "headline", "date", "pub", "text")
+FORMAT_VERSION = 1
+
+
+class DocumentStoreWriter:
+    def __init__(self, path):
+        os.makedirs(path, exist_ok=True)
+        # Invalidate a previous store in the same directory until close()
+        if os.path.isfile(os.path.join(path, "meta.json")):
+            os.remove(os.path.join(path, "meta.json"))
+        self.path = path
+        self.num_docs = 0
+        self.files = {
+            column: open(os.path.join(path, f"{column}.bin"), "wb")
+            for column in COLUMNS
+        }
+        self.offsets = {column: array("q", [0]) for column in COLUMNS}
+        # None and "" are different values (e.g. a document without <TEXT>)
+        self.present = {column: bytearray() for column in COLUMNS}
+
+    def add(self, doc):
+        for column in COLUMNS:
+            value = getattr(doc, column)
+            offsets = self.offsets[column]
+            if value:
+                data = value.encode("utf-8")
+                self.files[column].write(data)
+                offsets.append(offsets[-1] + len(data))
+            else:
+                offsets.append(offsets[-1])
+            self.present[column].append(value is not None)
+        self.num_docs += 1
+
+    def close(self):
+        for column in COLUMNS:
+            self.files[column].close()
+            np.save(
+                os.path.join(self.path, f"{column}.offsets.npy"),
+                np.frombuffer(self.offsets[column], dtype=np.int64),
+            )
+            np.save(
+                os.path.join(self.path, f"{column}.present.npy"),
+                np.frombuffer(bytes(self.present[column]), dtype=np.bool_),
+            )
+        # meta.json is written last, so a store without it is incomplete
+        with open(os.path.join(self.path, "meta.json"), "w") as f:
+            json.dump(
+                {
+                    "format_version": FORMAT_VERSION,
+                    "num_docs": self.num_docs,
+                    "columns": list(COLUMNS),
+                },
+                f,
+            )
+
+    def abort(self):
+        # Close the column files without writing meta.json, so the partial
+        # store cannot be opened
+        for column in COLUMNS:
+            self.files[column].close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Only a store whose documents were all written is marked complete;
+        # the exception, if any, propagates
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def write_document_store(documents, path):
+    # Stream documents into a columnar store; returns the set of doc_ids written
+    doc_ids = set()
+    with DocumentStoreWriter(path) as writer:
+        for doc in documents:
+            writer.add(doc)
+            if doc.doc_no is not None:
+                doc_ids.add(doc.doc_no)
+    return doc_ids
+
+
+def convert_pickle_to_store(pickle_path, path):
+    # Migrate an existing docs.pkl (list or record stream) to a document store
+    return write_document_store(iter_pickled_documents(pickle_path), path)
+
+
+class DocumentStore:
+    def __init__(self, path):
+        meta_path = os.path.join(path, "meta.json")
+        if not os.path.isfile(meta_path):
+            raise FileNotFoundError(f"No complete document store at {path}")
+        with open(meta_path, "r") as f:
+            meta = json.load(f)
+        if meta["format_version"] != FORMAT_VERSION:
+            raise ValueError(
+                f"Unsupported document store version {meta['format_version']}"
+            )
+
+        self.path = path
+        self.num_docs = meta["num_docs"]
+        self.columns = meta["columns"]
+        self._column_data = {}
+        self._rows_by_doc_no = None
+
+    def __len__(self):
+        return self.num_docs
+
+    def _open_column(self, column):
+        # Columns are only mapped the first time they are touched
+        if column not in self._column_data:
+            if column not in self.columns:
+                raise KeyError(f"Unknown column: {column}")
+            blob_path = os.path.join(self.path, f"{column}.bin")
+            if os.path.getsize(blob_path) > 0:
+                blob = np.memmap(blob_path, dtype=np.uint8, mode="r")
+            else:
+                blob = np.empty(0, dtype=np.uint8)  # mmap cannot map an empty file
+            offsets = np.load(
+                os.path.join(self.path, f"{column}.offsets.npy"), mmap_mode="r"
+            )
+            present = np.load(
+                os.path.join(self.path, f"{column}.present.npy"), mmap_mode="r"
+            )
+            self._column_data[column] = (blob, offsets, present)
+        return self._column_data[column]
+
+    def get(self, row, column):
+        blob, offsets, present = self._open_column(column)
+        if not present[row]:
+            return None
+        return blob[offsets[row] : offsets[row + 1]].tobytes().decode("utf-8")
+
+    def present(self, column):
+        # Boolean mask of rows where the column is not None
+        return self._open_column(column)[2]
+
+    def iter_column(self, column):
+        blob, offsets, present = self._open_column(column)
+        offsets = np.asarray(offsets).tolist()
+        present = np.asarray(present).tolist()
+        for row in range(self.num_docs):
+            if present[row]:
+                yield blob[offsets[row] : offsets[row + 1]].tobytes().decode("utf-8")
+            else:
+                yield None
+
+    def __getitem__(self, row):
+        if row < 0:
+            row += self.num_docs
+        if not 0 <= row < self.num_docs:
+            raise IndexError(f"Row {row} out of range")
+        return Document(**{column: self.get(row, column) for column in self.columns})
+
+    def row_of(self, doc_no):
+        if self._rows_by_doc_no is None:
+            self._rows_by_doc_no = {
+                value: row for row, value in enumerate(self.iter_column("doc_no"))
+            }
+        return self._rows_by_doc_no[doc_no]
+
+    def get_by_doc_no(self, doc_no):
+        return self[self.row_of(doc_no)]
+
+    def doc_ids(self):
+        return {doc_no for doc_no in self.iter_column("doc_no") if doc_no is not None}
@@ -4,39 +4,49 @@ from torch.utils.data import DataLoader, Dataset
 import torch
 import pickle
 from tqdm import tqdm
+import numpy as np
+from batching import (
+    ThroughputMeter,
+    TokenBudgetBatchSampler,
+    TokenizedDataset,
+    collate_token_ids,
+)
+from docstore import DocumentStore
+from embedding_store import EmbeddingWriter
+from inference import model_fingerprint, prepare_model
+from pooling import load_pooling_modes, pool
+from token_cache import load_or_build_token_cache
 
 # %%
 # Load data from data path
 data_path = "../data"
 
-# load docs
-with open(f"{data_path}/docs.pkl", "rb") as f:
-    docs = pickle.load(f)
+# Open the columnar document store; only documents with a text are embedded
+docstore = DocumentStore(f"{data_path}/docstore")
+doc_rows = np.flatnonzero(docstore.present("text"))
+doc_ids = [docstore.get(row, "doc_no") for row in doc_rows]
 
 # load queries
 with open(f"{data_path}/queries.pkl", "rb") as f:
     queries = pickle.load(f)
 
 # %%
-print(f"Number of documents: {len(docs)}")
+print(f"Number of documents: {len(doc_rows)}")
 print(f"Number of queries: {len(queries)}")
 
-# %%
-# Preprocess documents without any text
-docs = [doc for doc in docs if doc.text is not None]
-
 
 # %%
 class DocumentDataset(Dataset):
-    def __init__(self, documents):
-        self.documents = documents
+    def __init__(self, docstore, rows):
+        self.docstore = docstore
+        self.rows = rows
 
     def __len__(self):
-        return len(self.documents)
+        return len(self.rows)
 
     def __getitem__(self, idx):
-        # Return only the `text` attribute
-        return self.documents[idx].text
+        # Read only the `text` column of the row
+        return self.docstore.get(self.rows[idx], "text")
 
 
 class QueryDataset(Dataset):
@@ -51,103 +61,133 @@ class QueryDataset(Dataset):
         return self.queries[idx].query
 
 
-def collate_and_tokenize(batch, tokenizer, max_length=512):
-    return tokenizer(
-        batch, padding=True, truncation=True, max_length=max_length, return_tensors="pt"
-    )
-
-
 # %%
 # Initialize PyTorch dataset
 query_dataset = QueryDataset(queries)
-doc_dataset = DocumentDataset(docs)
+doc_dataset = DocumentDataset(docstore, doc_rows)
 
 # %%
 # Initialize model and tokenizer
-tokenizer = AutoTokenizer.from_pretrained(
-    "sentence-transformers/msmarco-bert-base-dot-v5"
-)
-model = AutoModel.from_pretrained("sentence-transformers/msmarco-bert-base-dot-v5")
-model = torch.nn.DataParallel(model)
+model_name = "sentence-transformers/msmarco-bert-base-dot-v5"
+tokenizer = AutoTokenizer.from_pretrained(model_name)
+model = AutoModel.from_pretrained(model_name)
+# Pool the way the model was trained (its sentence-transformers Pooling
+# config); documents and queries both go through compute_embeddings
+pooling_modes = load_pooling_modes(model_name)
+print(f"Pooling: {'+'.join(pooling_modes)}")
+
+# "bf16" or "int8" trade a little accuracy for faster CPU inference; reduced
+# precision embeddings go to their own directories so eval_pipeline.py can
+# report the metric drift against the fp32 ones
+precision = "fp32"
+embedding_suffix = "" if precision == "fp32" else f"_{precision}"
+model = prepare_model(model, precision)
+if torch.cuda.device_count() > 1:
+    model = torch.nn.DataParallel(model)
+# On CPU-only nodes, cpu_embed.py runs several model replicas in parallel
+# processes and writes the same query_embeddings/doc_embeddings
 
 # %%
-batch_size = 4096
-
-# Create DataLoaders
-document_loader = DataLoader(
-    doc_dataset,
-    batch_size=batch_size,
-    shuffle=False,
-    collate_fn=lambda batch: collate_and_tokenize(batch, tokenizer),
+max_length = 512
+# Padded tokens per batch (batch size x longest document in the batch)
+max_tokens = 65536
+
+# Token ids are cached on disk per tokenizer, max_length and corpus, so only the
+# first run tokenizes; documents of similar length are then packed together
+token_cache_path = f"{data_path}/token_cache"
+doc_input_ids, doc_offsets = load_or_build_token_cache(
+    doc_dataset, tokenizer, max_length, token_cache_path
 )
-
-query_loader = DataLoader(
-    query_dataset,
-    batch_size=batch_size,
-    shuffle=False,
-    collate_fn=lambda batch: collate_and_tokenize(batch, tokenizer),
+query_input_ids, query_offsets = load_or_build_token_cache(
+    query_dataset, tokenizer, max_length, token_cache_path
 )
 
 
-# %%
-def mean_pooling(model_output, attention_mask):
-    token_embeddings = model_output.last_hidden_state  # Extract the last hidden state
-    input_mask_expanded = (
-        attention_mask.unsqueeze(-1).expand(token_embeddings.size()).float()
-    )
-    return torch.sum(token_embeddings * input_mask_expanded, 1) / torch.clamp(
-        input_mask_expanded.sum(1), min=1e-9
+def collate_fn(batch):
+    return collate_token_ids(
+        batch,
+        tokenizer.pad_token_id,
+        "token_type_ids" in tokenizer.model_input_names,
     )
 
 
-def cls_pooling(model_output):
-    # The [CLS] token is at index 0
-    return model_output.last_hidden_state[:, 0, :].cpu()  # Output the [CLS] token
+# Create datasets over the cached token ids
+document_tokens = TokenizedDataset(doc_input_ids, doc_offsets)
+query_tokens = TokenizedDataset(query_input_ids, query_offsets)
+
+# Embeddings are written shard by shard to disk; a rerun resumes at the first
+# missing shard. float16 halves the file size
+shard_size = 16384
+embedding_dtype = "float32"
 
 
+# %%
 def compute_embeddings(
-    loader, model, device="cuda" if torch.cuda.is_available() else "cpu"
+    dataset,
+    ids,
+    output_path,
+    model,
+    device="cuda" if torch.cuda.is_available() else "cpu",
 ):
     model.to(device)
     model.eval()
 
-    embeddings = []
+    config = getattr(model, "module", model).config
+    writer = EmbeddingWriter(
+        output_path,
+        ids,
+        config.hidden_size * len(pooling_modes),
+        embedding_dtype,
+        shard_size,
+        meta={
+            "model": config.name_or_path,
+            "model_hash": model_fingerprint(model_name),
+            "max_length": max_length,
+            "precision": precision,
+            "pooling": list(pooling_modes),
+        },
+    )
+    lengths = dataset.lengths()
+    meter = ThroughputMeter()
     with torch.no_grad():
-        for batch in tqdm(loader, desc="Computing embeddings"):
-            # Pass tokenized data to the model
-            batch = {key: value.to(device) for key, value in batch.items()}
-            with torch.no_grad():
+        for shard_id, start, end in tqdm(
+            writer.pending_shards(), desc=f"Computing {output_path}"
+        ):
+            # Pack the rows of this shard by length, then restore their order
+            batches = [
+                [start + idx for idx in batch]
+                for batch in TokenBudgetBatchSampler(lengths[start:end], max_tokens)
+            ]
+            loader = DataLoader(dataset, batch_sampler=batches, collate_fn=collate_fn)
+            shard = torch.empty((end - start, writer.embeddings.shape[1]))
+            for rows, batch in loader:
+                meter.update(batch["attention_mask"])
+                # Pass tokenized data to the model
+                batch = {key: value.to(device) for key, value in batch.items()}
                 model_output = model(**batch)
-            # batch_embeddings = mean_pooling(model_output, batch["attention_mask"])
-            batch_embeddings = cls_pooling(model_output)
-            embeddings.append(batch_embeddings)
+                embeddings = pool(
+                    model_output.last_hidden_state, batch["attention_mask"], pooling_modes
+                )
+                shard[rows - start] = embeddings.float().cpu()
+            writer.write_shard(shard_id, shard.numpy())
 
-    return torch.cat(embeddings, dim=0)
+    writer.finalize()
+    meter.stop()
+    print(f"Throughput: {meter}")
+    return writer.embeddings
 
 
 # %%
 # Compute embeddings
-query_embeddings = compute_embeddings(query_loader, model)
+query_embeddings = compute_embeddings(
+    query_tokens,
+    [query.query_no for query in queries],
+    f"query_embeddings{embedding_suffix}",
+    model,
+)
 print("Query Embeddings Shape:", query_embeddings.shape)
 
-doc_embeddings = compute_embeddings(document_loader, model)
+doc_embeddings = compute_embeddings(
+    document_tokens, doc_ids, f"doc_embeddings{embedding_suffix}", model
+)
 print("Document Embeddings Shape:", doc_embeddings.shape)
-
-# %%
-with open("doc_embeddings.pkl", "wb") as f:
-    pickle.dump(
-        {
-            "embeddings": doc_embeddings.cpu().numpy(),
-            "doc_ids": [doc.doc_no for doc in docs],
-        },
-        f,
-    )
-
-with open("query_embeddings.pkl", "wb") as f:
-    pickle.dump(
-        {
-            "embeddings": query_embeddings.cpu().numpy(),
-            "query_ids": [query.query_no for query in queries],
-        },
-        f,
-    )
@@ -0,0 +1,109 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+MANIFEST_NAME = "manifest.json"
+
+
+def save_manifest(path, manifest):
+    # Replace the manifest atomically so a crash never leaves it half written
+    manifest_path = os.path.join(path, MANIFEST_NAME)
+    with open(f"{manifest_path}.tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+
+
+def load_manifest(path):
+    manifest_path = os.path.join(path, MANIFEST_NAME)
+    if not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path, "r") as f:
+        return json.load(f)
+
+
+class EmbeddingWriter:
+    """
+    Writes an embedding matrix shard by shard into a preallocated .npy file.
+
+    Completed shards are recorded in manifest.json after they are flushed, so
+    a new writer with the same settings resumes at the first missing shard.
+    Any change to ids, dimension, dtype, shard size or meta starts over.
+    """
+
+    def __init__(self, path, ids, dim, dtype="float32", shard_size=16384, meta=None):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.num_rows = len(ids)
+        self.shard_size = shard_size
+        settings = {
+            "num_rows": self.num_rows,
+            "ids_sha1": hashlib.sha1("\n".join(ids).encode("utf-8")).hexdigest(),
+            "dim": dim,
+            "dtype": np.dtype(dtype).name,
+            "shard_size": shard_size,
+            "meta": meta or {},
+        }
+        embeddings_path = os.path.join(path, "embeddings.npy")
+
+        manifest = load_manifest(path)
+        if (
+            manifest is not None
+            and os.path.isfile(embeddings_path)
+            and all(manifest.get(key) == value for key, value in settings.items())
+        ):
+            print(f"Resuming {path}: {len(manifest['completed_shards'])} shards already done")
+            self.embeddings = np.load(embeddings_path, mmap_mode="r+")
+        else:
+            manifest = dict(settings, completed_shards=[], complete=False)
+            self.embeddings = np.lib.format.open_memmap(
+                embeddings_path, mode="w+", dtype=dtype, shape=(self.num_rows, dim)
+            )
+            with open(os.path.join(path, "ids.txt"), "w", encoding="utf-8") as f:
+                f.writelines(f"{row_id}\n" for row_id in ids)
+            save_manifest(path, manifest)
+        self.manifest = manifest
+
+    def shards(self):
+        for shard_id, start in enumerate(range(0, self.num_rows, self.shard_size)):
+            yield shard_id, start, min(start + self.shard_size, self.num_rows)
+
+    def pending_shards(self):
+        completed = set(self.manifest["completed_shards"])
+        return [shard for shard in self.shards() if shard[0] not in completed]
+
+    def write_shard(self, shard_id, embeddings):
+        start = shard_id * self.shard_size
+        self.embeddings[start : start + len(embeddings)] = embeddings
+        self.mark_shard_done(shard_id)
+
+    def mark_shard_done(self, shard_id):
+        # For shards whose rows were written into embeddings.npy by another
+        # process; the file is shared, so flushing this mapping persists them
+        self.embeddings.flush()
+        self.manifest["completed_shards"].append(shard_id)
+        save_manifest(self.path, self.manifest)
+
+    def finalize(self):
+        if self.pending_shards():
+            raise RuntimeError(f"{self.path} still has pending shards")
+        self.manifest["complete"] = True
+        save_manifest(self.path, self.manifest)
+
+
+def open_embeddings(path):
+    """
+    Opens a completed embedding matrix without copying it.
+
+    Returns:
+        (embeddings, ids, manifest): a read-only memmap of shape
+        (num_rows, dim), the row ids and the manifest
+    """
+    manifest = load_manifest(path)
+    if manifest is None or not manifest.get("complete"):
+        raise FileNotFoundError(f"No complete embeddings at {path}")
+    embeddings = np.load(os.path.join(path, "embeddings.npy"), mmap_mode="r")
+    with open(os.path.join(path, "ids.txt"), "r", encoding="utf-8") as f:
+        ids = f.read().splitlines()
+    return embeddings, ids, manifest
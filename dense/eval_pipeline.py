@@ -1,17 +1,28 @@
 # %%
+import os
 import pickle
-
-# Load document embeddings
-with open("doc_embeddings.pkl", "rb") as f:
-    doc_data = pickle.load(f)
-doc_embeddings = doc_data["embeddings"]
-doc_ids = doc_data["doc_ids"]
-
-# Load query embeddings
-with open("query_embeddings.pkl", "rb") as f:
-    query_data = pickle.load(f)
-query_embeddings = query_data["embeddings"]
-query_ids = query_data["query_ids"]
+import numpy as np
+from embedding_store import open_embeddings
+from inference import metric_drift, print_drift
+from run import Run
+
+# Precision the embeddings were computed with in embed_pipeline.py; anything
+# but fp32 is also compared against the fp32 embeddings at the end
+precision = "fp32"
+embedding_suffix = "" if precision == "fp32" else f"_{precision}"
+
+# Open the embedding matrices written by embed_pipeline.py (memory-mapped, no copy)
+doc_embeddings_path = f"doc_embeddings{embedding_suffix}"
+doc_embeddings, doc_ids, doc_manifest = open_embeddings(doc_embeddings_path)
+query_embeddings, query_ids, query_manifest = open_embeddings(
+    f"query_embeddings{embedding_suffix}"
+)
+# Scores are only meaningful if both sides were encoded the same way
+if doc_manifest["meta"] != query_manifest["meta"]:
+    raise ValueError(
+        f"Documents and queries were embedded differently: "
+        f"{doc_manifest['meta']} vs {query_manifest['meta']}"
+    )
 
 print("Document Embeddings Shape:", doc_embeddings.shape)
 print("Query Embeddings Shape:", query_embeddings.shape)
@@ -29,17 +40,66 @@ queries_filtered = [query for query in queries if query.number_of_relevant_docs
 print("Number of Queries with Relevant Documents:", len(queries_filtered))
 
 # %%
-import faiss
-
-embedding_dim = doc_embeddings.shape[1]
-index = faiss.IndexFlatIP(embedding_dim)
-
-faiss.normalize_L2(doc_embeddings)  # normalize before adding to index
-faiss.normalize_L2(query_embeddings)  # normalize before searching
-
-index.add(doc_embeddings)
-
-print(f"FAISS index contains {index.ntotal} embeddings.")
+from exact_search import exact_search
+
+# "faiss" searches an index built with ann_index.py; "exact" streams the
+# memory-mapped embeddings through blocked matrix multiplications and needs
+# no FAISS (bench_exact_search.py checks it against the flat index)
+search_backend = "faiss"
+if search_backend == "faiss":
+    import faiss
+    from ann_index import (
+        build_index,
+        index_file_name,
+        index_manifest,
+        load_valid_index,
+        save_index,
+        set_search_params,
+    )
+
+# "flat" is exact; "ivf_flat", "ivf_pq", "hnsw" and "opq_ivf_pq" trade recall
+# for memory and latency (bench_ann.py sweeps them against flat)
+index_type = "flat"
+index_params = {}  # e.g. {"nlist": 4096, "pq_m": 64} or {"hnsw_m": 32}
+search_params = {}  # e.g. {"nprobe": 64} or {"ef_search": 256}
+# Save the index next to the embeddings and memory-map it on later runs, for
+# as long as its manifest matches the embeddings and index settings
+persist_index = True
+
+
+def load_or_build_index(embeddings_path, doc_embeddings, manifest):
+    if search_backend == "exact":
+        # Searched block by block straight from the memmap
+        return doc_embeddings
+    expected_manifest = index_manifest(
+        index_type,
+        index_params,
+        True,
+        manifest["num_rows"],
+        ids_sha1=manifest["ids_sha1"],
+        dtype=manifest["dtype"],
+        **manifest["meta"],
+    )
+    index_path = os.path.join(embeddings_path, index_file_name(expected_manifest))
+    index = load_valid_index(index_path, expected_manifest) if persist_index else None
+    if index is None:
+        # Documents are normalized block by block while they are added
+        index = build_index(doc_embeddings, index_type, **index_params)
+        if persist_index:
+            save_index(index, index_path, expected_manifest)
+    else:
+        print(f"Memory-mapped {index_path} ({index.ntotal} embeddings)")
+    return index
+
+
+def search(index, query_embeddings, top_k):
+    if search_backend == "exact":
+        return exact_search(index, query_embeddings, top_k)
+    set_search_params(index, **search_params)
+
+    query_embeddings = np.array(query_embeddings, dtype=np.float32)
+    faiss.normalize_L2(query_embeddings)  # normalize before searching
+    return index.search(query_embeddings, top_k)
 
 
 # %%
@@ -47,58 +107,44 @@ print(f"FAISS index contains {index.ntotal} embeddings.")
 top_k = 1000
 
 # Search the index with normalized query embeddings
-distances, indices = index.search(query_embeddings, top_k)
+index = load_or_build_index(doc_embeddings_path, doc_embeddings, doc_manifest)
+distances, indices = search(index, query_embeddings, top_k)
 
 print("Distances Shape:", distances.shape)  # (num_queries, top_k)
 print("Indices Shape:", indices.shape)  # (num_queries, top_k)
 
 # %%
-# Map indices to document IDs and reverse the order by similarity
-results_map = [
-    {
-        "query_id": query_ids[i],
-        "top_docs": sorted(
-            [
-                {"doc_id": doc_ids[idx], "similarity": distances[i][j]}
-                for j, idx in enumerate(indices[i])
-            ],
-            key=lambda x: x["similarity"],
-            reverse=True,
-        ),
-    }
-    for i in range(len(query_ids))
-]
+# Both backends return hits sorted by similarity; the run keeps its arrays as they are
+run = Run(query_ids, doc_ids, distances, indices)
+run.write_trec(f"run{embedding_suffix}.trec", system=f"dense{embedding_suffix}")
 
 # # Print results for each query
-# for result in results:
-#     print(f"Query ID: {result['query_id']}")
-#     for doc in result["top_docs"]:
-#         print(f"  Doc ID: {doc['doc_id']}\t Similarity: {doc['similarity']:.6f}")
+# for row, query_id in enumerate(run.query_ids):
+#     print(f"Query ID: {query_id}")
+#     for doc_id, similarity in zip(*run.hits(row)):
+#         print(f"  Doc ID: {doc_id}\t Similarity: {similarity:.6f}")
 
 
 # %%
 # Evaluation
 import pytrec_eval
+from evaluation import Evaluator, mean_metrics as average_metrics, per_query
+
+# Score runs on the arrays with the NumPy evaluator (same values as
+# pytrec_eval to 1e-6, see bench_evaluation.py), or with pytrec_eval itself
+use_native_evaluator = True
 
 # Create qrels from queries
 qrels = {
     query.query_no: {
-        doc_id: 1 for doc_id in query.relevant_docs
-    }  # Relevance score = 1 for relevant documents
+        doc_id: query.get_relevance(doc_id) for doc_id in query.relevant_docs
+    }  # Graded relevance label of each relevant document
     for query in queries_filtered
 }
 
 
 # print(qrels)
 
-# %%
-run = {
-    query_ids[i]: {
-        doc_ids[idx]: float(distances[i][j]) for j, idx in enumerate(indices[i])
-    }
-    for i in range(len(query_ids))
-}
-
 # %%
 # Define evaluation metrics
 metrics = {
@@ -128,17 +174,31 @@ metrics = {
 }
 
 # Initialize evaluator
-evaluator = pytrec_eval.RelevanceEvaluator(qrels, metrics.keys())
+if use_native_evaluator:
+    evaluator = Evaluator(qrels, doc_ids)
+else:
+    evaluator = pytrec_eval.RelevanceEvaluator(qrels, metrics.keys())
 
-# Compute metrics
-results = evaluator.evaluate(run)
 
-mean_metrics = {}
+def evaluate_run(run):
+    # Per-query metrics and their means
+    if use_native_evaluator:
+        evaluated_query_ids, metric_values = evaluator.evaluate(run, metrics.keys())
+        return per_query(evaluated_query_ids, metric_values), average_metrics(metric_values)
+
+    results = evaluator.evaluate(run.to_dict())
+
+    mean_metrics = {}
+
+    for metric in results[next(iter(results))].keys():  # Get metrics from the first query
+        mean_metrics[metric] = sum(
+            query_metrics[metric] for query_metrics in results.values()
+        ) / len(results)
+    return results, mean_metrics
 
-for metric in results[next(iter(results))].keys():  # Get metrics from the first query
-    mean_metrics[metric] = sum(
-        query_metrics[metric] for query_metrics in results.values()
-    ) / len(results)
+
+# Compute metrics
+results, mean_metrics = evaluate_run(run)
 
 for metric, value in mean_metrics.items():
     print(f"{metric}: {value:.4f}")
@@ -152,3 +212,19 @@ for query_id, query_metrics in results.items():
         print(f"  {metrics[metric]}: {value:.4f}")
 
 # %%
+# Metric drift of reduced precision embeddings against the fp32 baseline
+if precision != "fp32":
+    baseline_doc_embeddings, baseline_doc_ids, baseline_manifest = open_embeddings(
+        "doc_embeddings"
+    )
+    baseline_query_embeddings, baseline_query_ids, _ = open_embeddings("query_embeddings")
+    assert baseline_doc_ids == doc_ids and baseline_query_ids == query_ids
+    baseline_index = load_or_build_index(
+        "doc_embeddings", baseline_doc_embeddings, baseline_manifest
+    )
+    _, baseline_metrics = evaluate_run(
+        Run(query_ids, doc_ids, *search(baseline_index, baseline_query_embeddings, top_k))
+    )
+    print_drift(metric_drift(baseline_metrics, mean_metrics), precision)
+
+# %%
@@ -0,0 +1,70 @@
+import numpy as np
+
+# FAISS pads missing hits with index -1 and the lowest float32 score
+PADDING_SCORE = -np.finfo(np.float32).max
+
+
+def normalize_rows(block):
+    # L2-normalize in place, leaving all-zero rows as they are like faiss.normalize_L2
+    norms = np.linalg.norm(block, axis=1, keepdims=True)
+    np.divide(block, norms, out=block, where=norms > 0)
+    return block
+
+
+def top_k_of(scores, indices, top_k):
+    # Unordered top_k columns of every row
+    if scores.shape[1] <= top_k:
+        return scores, indices
+    columns = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+    return np.take_along_axis(scores, columns, 1), np.take_along_axis(indices, columns, 1)
+
+
+def exact_search(
+    doc_embeddings,
+    query_embeddings,
+    top_k,
+    block_size=16384,
+    query_batch_size=1024,
+    normalize=True,
+):
+    """
+    Exact inner-product top_k search without FAISS.
+
+    Document blocks of doc_embeddings (an array or memmap of shape
+    (num_docs, dim), of any float dtype) are read once, in row order, and
+    scored against every query batch with one matrix multiplication; a
+    running top_k per query is kept with argpartition. Only one block is in
+    memory at a time, so the matrix can be larger than RAM. With normalize,
+    both sides are L2-normalized so scores are cosine similarities.
+
+    Returns:
+        (scores, indices) of shape (num_queries, top_k) like faiss
+        Index.search: best first, padded with -1 past num_docs
+    """
+    queries = np.array(query_embeddings, dtype=np.float32)
+    if normalize:
+        normalize_rows(queries)
+    num_queries = len(queries)
+    top_scores = np.full((num_queries, top_k), PADDING_SCORE, dtype=np.float32)
+    top_indices = np.full((num_queries, top_k), -1, dtype=np.int64)
+
+    for start in range(0, len(doc_embeddings), block_size):
+        block = np.array(doc_embeddings[start : start + block_size], dtype=np.float32)
+        if normalize:
+            normalize_rows(block)
+        block_indices = np.arange(start, start + len(block), dtype=np.int64)
+        for query_start in range(0, num_queries, query_batch_size):
+            rows = slice(query_start, query_start + query_batch_size)
+            block_scores, candidates = top_k_of(
+                queries[rows] @ block.T,
+                np.broadcast_to(block_indices, (len(queries[rows]), len(block))),
+                top_k,
+            )
+            top_scores[rows], top_indices[rows] = top_k_of(
+                np.concatenate([top_scores[rows], block_scores], axis=1),
+                np.concatenate([top_indices[rows], candidates], axis=1),
+                top_k,
+            )
+
+    order = np.argsort(-top_scores, axis=1, kind="stable")
+    return np.take_along_axis(top_scores, order, 1), np.take_along_axis(top_indices, order, 1)
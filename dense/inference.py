@@ -0,0 +1,82 @@
+import copy
+import hashlib
+import json
+import os
+
+import torch
+from huggingface_hub import hf_hub_download
+
+PRECISIONS = ("fp32", "bf16", "int8")
+
+
+def prepare_model(model, precision="fp32"):
+    """
+    Returns model in eval mode, set up for inference at the given precision.
+
+    fp32: the model unchanged
+    bf16: weights and activations in bfloat16 (CPUs with AVX512-BF16/AMX
+        run this natively, older ones emulate it and may be slower)
+    int8: dynamic int8 quantization of every nn.Linear, with activations
+        quantized on the fly; CPU only
+
+    Reduced precisions work on a copy, so the fp32 model stays usable as
+    the baseline for metric_drift.
+
+    Embeddings come out in the model's dtype, so callers should cast them
+    with .float() before indexing.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision!r}, expected one of {PRECISIONS}")
+    model.eval()
+    if precision == "bf16":
+        return copy.deepcopy(model).to(torch.bfloat16)
+    if precision == "int8":
+        if any(parameter.is_cuda for parameter in model.parameters()):
+            raise ValueError("int8 dynamic quantization only runs on CPU")
+        return torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+    return model
+
+
+def model_fingerprint(model_name_or_path):
+    """
+    Identifies a model's weights and configs without reading the weights:
+    the commit of a Hub model, or the names, sizes and mtimes of the files
+    of a local checkpoint (a copied checkpoint therefore counts as new).
+    """
+    if os.path.isdir(model_name_or_path):
+        entries = []
+        for root, _, file_names in os.walk(model_name_or_path):
+            for file_name in file_names:
+                if not file_name.endswith((".json", ".safetensors", ".bin", ".txt", ".model")):
+                    continue
+                file_path = os.path.join(root, file_name)
+                stat = os.stat(file_path)
+                entries.append(
+                    (os.path.relpath(file_path, model_name_or_path), stat.st_size, stat.st_mtime_ns)
+                )
+        return hashlib.sha1(json.dumps(sorted(entries)).encode("utf-8")).hexdigest()
+    # Hub files are cached under snapshots/<commit hash>/
+    return os.path.basename(os.path.dirname(hf_hub_download(model_name_or_path, "config.json")))
+
+
+def metric_drift(baseline, candidate, metrics=("ndcg_cut_10", "map")):
+    """
+    Compares mean retrieval metrics of a reduced-precision run against the
+    fp32 baseline.
+
+    Returns:
+        {metric: (baseline, candidate, candidate - baseline)}
+    """
+    return {
+        metric: (baseline[metric], candidate[metric], candidate[metric] - baseline[metric])
+        for metric in metrics
+    }
+
+
+def print_drift(drift, precision):
+    print(f"\n=== {precision} vs fp32 ===")
+    print(f"{'Metric':<15} {'fp32':>8} {precision:>8} {'Drift':>9}")
+    for metric, (baseline, candidate, delta) in drift.items():
+        print(f"{metric:<15} {baseline:>8.4f} {candidate:>8.4f} {delta:>+9.4f}")
@@ -1,7 +1,15 @@
+import bisect
+import multiprocessing
 import os
+import pickle
+import re
+import time
+from array import array
 
 
 class Document:
+    __slots__ = ("doc_no", "profile", "date", "headline", "text", "pub", "page")
+
     def __init__(
         self,
         doc_no=None,
@@ -23,32 +31,124 @@ class Document:
     def __str__(self):
         return f"Document(doc_no='{self.doc_no}', headline='{self.headline}', text='{self.text}')"
 
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __setstate__(self, state):
+        # Also accepts the __dict__ of Document pickles written before __slots__
+        for name in self.__slots__:
+            setattr(self, name, state.get(name))
+
+
+class DocIndex:
+    # Interns doc_no strings as small integers shared by every Query
+    def __init__(self):
+        self.doc_nos = []
+        self.ids = {}
+
+    def id_of(self, doc_no):
+        doc_id = self.ids.get(doc_no)
+        if doc_id is None:
+            doc_id = len(self.doc_nos)
+            self.ids[doc_no] = doc_id
+            self.doc_nos.append(doc_no)
+        return doc_id
+
+    def doc_nos_of(self, doc_ids):
+        return [self.doc_nos[doc_id] for doc_id in doc_ids]
+
+
+doc_index = DocIndex()
+
+
+def add_doc_id(doc_ids, doc_id):
+    # Keep the array sorted and free of duplicates
+    position = bisect.bisect_left(doc_ids, doc_id)
+    if position == len(doc_ids) or doc_ids[position] != doc_id:
+        doc_ids.insert(position, doc_id)
+
+
+def contains_doc_id(doc_ids, doc_id):
+    position = bisect.bisect_left(doc_ids, doc_id)
+    return position < len(doc_ids) and doc_ids[position] == doc_id
+
+
+def to_doc_id_array(doc_nos):
+    return array("i", sorted({doc_index.id_of(doc_no) for doc_no in doc_nos or ()}))
+
 
 class Query:
+    # Relevant documents are a sorted array of doc_index ids instead of a doc_no list
+    __slots__ = ("query_no", "query", "relevant_ids", "relevance_levels")
+
     def __init__(self, query_no=None, query=None, relevant_docs=None):
         self.query_no = query_no
         self.query = query
-        self.number_of_relevant_docs = 0
-        self.relevant_docs = relevant_docs
+        self.relevant_ids = to_doc_id_array(relevant_docs)
+        self.relevance_levels = None  # doc id -> graded label, only for labels other than 1
 
     def __str__(self):
         return f"Query(query_no='{self.query_no}', query='{self.query}', relevant_docs='{self.relevant_docs}')"
 
-    def add_relevant_doc(self, doc_no):
-        if self.relevant_docs is None:
-            self.relevant_docs = []
-        self.number_of_relevant_docs += 1
-        self.relevant_docs.append(doc_no)
+    @property
+    def relevant_docs(self):
+        # None when nothing was judged relevant, like the old attribute
+        return doc_index.doc_nos_of(self.relevant_ids) if self.relevant_ids else None
+
+    @property
+    def number_of_relevant_docs(self):
+        return len(self.relevant_ids)
+
+    def add_relevant_doc(self, doc_no, relevance=1):
+        doc_id = doc_index.id_of(doc_no)
+        add_doc_id(self.relevant_ids, doc_id)
+        if relevance != 1:
+            if self.relevance_levels is None:
+                self.relevance_levels = {}
+            self.relevance_levels[doc_id] = relevance
 
     def update_relevant_docs(self, relevant_docs):
-        self.relevant_docs = relevant_docs
+        self.relevant_ids = to_doc_id_array(relevant_docs)
 
     def get_relevant_docs(self):
         return self.relevant_docs
 
+    def get_relevance(self, doc_no):
+        doc_id = doc_index.ids.get(doc_no)
+        if doc_id is None:
+            return 0
+        if self.relevance_levels and doc_id in self.relevance_levels:
+            return self.relevance_levels[doc_id]
+        return 1 if contains_doc_id(self.relevant_ids, doc_id) else 0
+
+    def __getstate__(self):
+        # Pickled with doc_no strings so the file does not depend on doc_index
+        levels = self.relevance_levels or {}
+        return {
+            "query_no": self.query_no,
+            "query": self.query,
+            "relevant_docs": self.relevant_docs,
+            "relevance_levels": {
+                doc_index.doc_nos[doc_id]: level for doc_id, level in levels.items()
+            },
+        }
+
+    def __setstate__(self, state):
+        # Also accepts the __dict__ of Query pickles written before __slots__
+        self.__init__(
+            state.get("query_no"), state.get("query"), state.get("relevant_docs")
+        )
+        levels = state.get("relevance_levels")
+        if levels:
+            self.relevance_levels = {
+                doc_index.id_of(doc_no): level for doc_no, level in levels.items()
+            }
+
 
-def parse_relevance(file_paths, queries, doc_ids):
-    processed_files = 0
+def parse_relevance(file_paths, queries, doc_ids, relevance_threshold=1):
+    # Index the queries once so every judgment is joined with a dict lookup
+    queries_by_no = {query.query_no: query for query in queries}
+    stats = []
 
     for file_path in file_paths:
         if not os.path.exists(file_path):
@@ -60,22 +160,52 @@ def parse_relevance(file_paths, queries, doc_ids):
             continue
 
         print(f"Processing: {file_path}")
-        processed_files += 1
+        start_time = time.perf_counter()
+        file_stats = {
+            "file": file_path,
+            "lines": 0,
+            "relevant": 0,
+            "non_relevant": 0,
+            "unknown_query": 0,
+            "unknown_doc": 0,
+            "malformed": 0,
+        }
 
+        # qrels files are small enough to ingest in one read
         with open(file_path, "r") as file:
-            for line in file:
-                parts = line.strip().split()
-                if len(parts) == 4:
-                    query_no, _, doc_no, relevance = parts
-                    if relevance == "1" and doc_no in doc_ids:
-                        for query in queries:
-                            if query.query_no == query_no:
-                                query.add_relevant_doc(doc_no)
-                                break
-
-    if processed_files == 0:
+            lines = file.read().splitlines()
+
+        for line in lines:
+            file_stats["lines"] += 1
+            parts = line.split()
+            if len(parts) != 4 or not parts[3].lstrip("-").isdigit():
+                file_stats["malformed"] += 1
+                continue
+            query_no, _, doc_no, relevance = parts
+            if doc_no not in doc_ids:
+                file_stats["unknown_doc"] += 1
+                continue
+            query = queries_by_no.get(query_no)
+            if query is None:
+                file_stats["unknown_query"] += 1
+                continue
+
+            # Graded labels: anything at or above the threshold counts as relevant
+            relevance = int(relevance)
+            if relevance >= relevance_threshold:
+                query.add_relevant_doc(doc_no, relevance)
+                file_stats["relevant"] += 1
+            elif relevance >= 0:
+                file_stats["non_relevant"] += 1
+
+        file_stats["seconds"] = time.perf_counter() - start_time
+        stats.append(file_stats)
+
+    if not stats:
         raise FileNotFoundError("None of the provided paths were valid files")
 
+    return stats
+
 
 def parse_queries(file_paths):
     queries = []
@@ -138,60 +268,119 @@ def extract_tag_content(lines, start_tag, end_tag):
     return " ".join(content)
 
 
-def parse_documents(directory_path):
+def iter_documents(directory_path, num_workers=1):
+    # Yield documents one at a time so callers never hold the whole corpus
+    file_paths = [
+        os.path.join(directory_path, file_name)
+        for file_name in os.listdir(directory_path)
+        if os.path.isfile(os.path.join(directory_path, file_name))
+    ]
+
+    if num_workers > 1 and len(file_paths) > 1:
+        # Each FT file is parsed independently; imap hands the results back in
+        # file order, so the output is identical to the serial path
+        with multiprocessing.Pool(min(num_workers, len(file_paths))) as pool:
+            for documents in pool.imap(parse_file, file_paths):
+                yield from documents
+    else:
+        for file_path in file_paths:
+            yield from iter_file_documents(file_path)
+
+
+def parse_file(file_path):
+    return list(iter_file_documents(file_path))
+
+
+# TREC/SGML fields we keep, mapped to the Document attribute they fill
+DOC_FIELDS = {
+    "DOCNO": "doc_no",
+    "PROFILE": "profile",
+    "DATE": "date",
+    "HEADLINE": "headline",
+    "TEXT": "text",
+    "PUB": "pub",
+    "PAGE": "page",
+}
+START_TAG_PATTERN = re.compile(r"<(" + "|".join(DOC_FIELDS) + r")>")
+
+
+def iter_file_documents(file_path, chunk_size=1 << 20):
+    with open(file_path, "r") as file:
+        buffer = ""
+        while True:
+            chunk = file.read(chunk_size)
+            buffer += chunk
+            # Hand every complete <DOC> block to the tokenizer, keep the partial tail
+            position = 0
+            while True:
+                end = buffer.find("</DOC>", position)
+                if end == -1:
+                    break
+                start = buffer.find("<DOC>", position, end)
+                if start != -1:
+                    yield parse_document(buffer[start + 5 : end])
+                position = end + 6
+            buffer = buffer[position:]
+            if not chunk:
+                break
+
+
+def parse_document(content):
+    # Single scan over the <DOC> body; fields may span several lines
+    doc = Document()
+    position = 0
+    while True:
+        match = START_TAG_PATTERN.search(content, position)
+        if match is None:
+            break
+        tag = match.group(1)
+        end = content.find(f"</{tag}>", match.end())
+        if end == -1:
+            break
+        value = content[match.end() : end]
+        if "\n" in value:
+            value = " ".join(map(str.strip, value.split("\n")))
+        setattr(doc, DOC_FIELDS[tag], value.strip())
+        position = end + len(tag) + 3
+    return doc
+
+
+def parse_documents(directory_path, num_workers=1):
     documents = []
     doc_ids = set()
 
-    for file_name in os.listdir(directory_path):
-        file_path = os.path.join(directory_path, file_name)
-        if os.path.isfile(file_path):
-            with open(file_path, "r") as file:
-                lines = file.readlines()
-
-            doc = None
-            current_text = []
-            inside_text = False  # Flag to track whether we're inside the <TEXT> tag
-            for line in lines:
-                line = line.strip()
-                if "<DOC>" in line:
-                    doc = Document()
-                elif "</DOC>" in line and doc:
-                    if current_text:
-                        doc.text = " ".join(current_text).strip()
-                        current_text = []
-                    documents.append(doc)
-                    doc = None
-                elif doc:
-                    if "<DOCNO>" in line:
-                        doc.doc_no = extract_tag_content([line], "<DOCNO>", "</DOCNO>")
-                        doc_ids.add(doc.doc_no)
-                    elif "<PROFILE>" in line:
-                        doc.profile = extract_tag_content(
-                            [line], "<PROFILE>", "</PROFILE>"
-                        )
-                    elif "<DATE>" in line:
-                        doc.date = extract_tag_content([line], "<DATE>", "</DATE>")
-                    elif "<HEADLINE>" in line:
-                        doc.headline = extract_tag_content(
-                            [line], "<HEADLINE>", "</HEADLINE>"
-                        )
-                    elif "<TEXT>" in line:
-                        inside_text = True
-                        current_text.append(
-                            extract_tag_content([line], "<TEXT>", "</TEXT>")
-                        )
-                    elif "</TEXT>" in line:
-                        inside_text = False
-                    elif inside_text:
-                        current_text.append(line)
-                    elif "<PUB>" in line:
-                        doc.pub = extract_tag_content([line], "<PUB>", "</PUB>")
-                    elif "<PAGE>" in line:
-                        doc.page = extract_tag_content([line], "<PAGE>", "</PAGE>")
+    for doc in iter_documents(directory_path, num_workers):
+        documents.append(doc)
+        if doc.doc_no is not None:
+            doc_ids.add(doc.doc_no)
 
     return documents, doc_ids
 
 
+def dump_documents(documents, file_path):
+    # Pickle one record per document so the output can be written and read as a stream
+    doc_ids = set()
+    with open(file_path, "wb") as file:
+        for doc in documents:
+            pickle.dump(doc, file, protocol=pickle.HIGHEST_PROTOCOL)
+            if doc.doc_no is not None:
+                doc_ids.add(doc.doc_no)
+    return doc_ids
+
+
+def iter_pickled_documents(file_path):
+    with open(file_path, "rb") as file:
+        while True:
+            try:
+                record = pickle.load(file)
+            except EOFError:
+                return
+            if isinstance(record, list):  # docs.pkl written before streaming
+                yield from record
+            else:
+                yield record
+
+
 def filter_relevance_file(relevance_paths, valid_doc_ids):
     for relevance_path in relevance_paths:
         with (
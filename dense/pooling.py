@@ -0,0 +1,94 @@
+import json
+import os
+
+import torch
+from huggingface_hub import hf_hub_download
+from huggingface_hub.utils import EntryNotFoundError
+
+# Keys of sentence_transformers.models.Pooling's config, in the order it
+# concatenates the modes
+CONFIG_KEYS = {
+    "cls": "pooling_mode_cls_token",
+    "max": "pooling_mode_max_tokens",
+    "mean": "pooling_mode_mean_tokens",
+    "mean_sqrt_len": "pooling_mode_mean_sqrt_len_tokens",
+    "weightedmean": "pooling_mode_weightedmean_tokens",
+}
+POOLING_MODES = tuple(CONFIG_KEYS)
+
+
+def _read_model_file(model_name_or_path, file_name):
+    if os.path.isdir(model_name_or_path):
+        path = os.path.join(model_name_or_path, file_name)
+        if not os.path.isfile(path):
+            return None
+    else:
+        try:
+            path = hf_hub_download(model_name_or_path, file_name)
+        except EntryNotFoundError:
+            return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def load_pooling_modes(model_name_or_path, default=("cls",)):
+    """
+    Returns the pooling modes a sentence-transformers model was trained with,
+    read from the config of its Pooling module (e.g. 1_Pooling/config.json).
+
+    Plain transformers checkpoints have no such config and get default.
+    """
+    modules = _read_model_file(model_name_or_path, "modules.json")
+    for module in modules or []:
+        if module["type"].endswith("Pooling"):
+            config = _read_model_file(model_name_or_path, f"{module['path']}/config.json")
+            if not config:
+                continue  # A Pooling module without its config keeps the default
+            if "pooling_mode" in config:
+                # Newer sentence-transformers save the mode (or modes) by name
+                modes = config["pooling_mode"]
+                modes = [modes] if isinstance(modes, str) else modes
+                modes = tuple(
+                    mode.removesuffix("_tokens").removesuffix("_token") for mode in modes
+                )
+            else:
+                modes = tuple(mode for mode, key in CONFIG_KEYS.items() if config.get(key))
+            if modes:
+                return modes
+    return tuple(default)
+
+
+def pool(last_hidden_state, attention_mask, modes=("cls",)):
+    """
+    Pools token embeddings (batch, seq, hidden) into one embedding per row,
+    concatenating the given modes like sentence-transformers does.
+
+    Masked sums are a batched (1 x seq) @ (seq x hidden) product per row, so
+    no mask of the size of the hidden states is built. Max pooling is the
+    exception: it needs a masked copy of the hidden states.
+    """
+    outputs = []
+    mask = attention_mask.to(last_hidden_state.dtype)
+    for mode in modes:
+        if mode == "cls":
+            # The [CLS] token is at index 0
+            outputs.append(last_hidden_state[:, 0])
+        elif mode == "max":
+            padding = (attention_mask == 0).unsqueeze(-1)
+            lowest = torch.finfo(last_hidden_state.dtype).min
+            outputs.append(last_hidden_state.masked_fill(padding, lowest).amax(1))
+        elif mode in ("mean", "mean_sqrt_len"):
+            summed = torch.bmm(mask.unsqueeze(1), last_hidden_state).squeeze(1)
+            counts = mask.sum(1, keepdim=True).clamp(min=1e-9)
+            outputs.append(summed / (counts if mode == "mean" else counts.sqrt()))
+        elif mode == "weightedmean":
+            # Later tokens weigh more: position i (from 1) has weight i
+            positions = torch.arange(
+                1, mask.shape[1] + 1, dtype=mask.dtype, device=mask.device
+            )
+            weights = mask * positions
+            summed = torch.bmm(weights.unsqueeze(1), last_hidden_state).squeeze(1)
+            outputs.append(summed / weights.sum(1, keepdim=True).clamp(min=1e-9))
+        else:
+            raise ValueError(f"Unknown pooling mode {mode!r}, expected one of {POOLING_MODES}")
+    return outputs[0] if len(outputs) == 1 else torch.cat(outputs, 1)
@@ -0,0 +1,57 @@
+import numpy as np
+
+
+class Run:
+    """
+    Ranked search results kept as the (scores, indices) arrays FAISS returns:
+    one row per query, hits already sorted by descending score, -1 where an
+    index found fewer than top_k documents.
+
+    The {query_id: {doc_id: score}} dict pytrec_eval expects is only built
+    when asked for, and run files are written straight from the arrays.
+    """
+
+    def __init__(self, query_ids, doc_ids, scores, indices):
+        if scores.shape != indices.shape or len(scores) != len(query_ids):
+            raise ValueError(
+                f"Expected {len(query_ids)} rows of scores and indices, "
+                f"got {scores.shape} and {indices.shape}"
+            )
+        self.query_ids = list(query_ids)
+        self.doc_ids = np.asarray(doc_ids, dtype=object)
+        self.scores = scores
+        self.indices = indices
+        self._dict = None
+
+    def __len__(self):
+        return len(self.query_ids)
+
+    @property
+    def top_k(self):
+        return self.indices.shape[1]
+
+    def hits(self, row):
+        # (doc ids, scores) of one query, best first
+        indices = self.indices[row]
+        found = indices >= 0
+        return self.doc_ids[indices[found]], self.scores[row][found]
+
+    def to_dict(self):
+        if self._dict is None:
+            self._dict = {}
+            for row, query_id in enumerate(self.query_ids):
+                doc_ids, scores = self.hits(row)
+                self._dict[query_id] = dict(zip(doc_ids.tolist(), scores.tolist()))
+        return self._dict
+
+    def write_trec(self, path, system="dense"):
+        # "query_id Q0 doc_id rank score system", ranks from 1
+        with open(path, "w", encoding="utf-8") as f:
+            for row, query_id in enumerate(self.query_ids):
+                doc_ids, scores = self.hits(row)
+                f.writelines(
+                    f"{query_id} Q0 {doc_id} {rank} {score:.6f} {system}\n"
+                    for rank, (doc_id, score) in enumerate(
+                        zip(doc_ids.tolist(), scores.tolist()), 1
+                    )
+                )
@@ -0,0 +1,26 @@
+import pytest
+
+from docstore import DocumentStore, write_document_store
+from parser import Document
+
+
+def documents(fail_after=None):
+    for i in range(5):
+        if i == fail_after:
+            raise RuntimeError("parse error")
+        yield Document(doc_no=f"FT-{i}", headline=f"headline {i}", text=f"text {i}")
+
+
+def test_complete_write_opens(tmp_path):
+    write_document_store(documents(), tmp_path)
+    store = DocumentStore(tmp_path)
+    assert len(store) == 5
+    assert store.get(4, "text") == "text 4"
+
+
+def test_failed_write_leaves_store_unopenable(tmp_path):
+    write_document_store(documents(), tmp_path)
+    with pytest.raises(RuntimeError):
+        write_document_store(documents(fail_after=3), tmp_path)
+    with pytest.raises(FileNotFoundError):
+        DocumentStore(tmp_path)
@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import torch
+import transformers
+
+CACHE_FORMAT_VERSION = 1
+
+
+def tokenize_corpus(texts, tokenizer, max_length=512, chunk_size=1024):
+    """
+    Tokenizes texts once, without padding, into ragged int32 arrays.
+
+    Returns:
+        (input_ids, offsets): all token ids back to back, and the int64
+        offsets where each text starts (len(texts) + 1 entries)
+    """
+    chunks = []
+    lengths = []
+
+    def encode(batch):
+        encoded = tokenizer(
+            batch,
+            truncation=True,
+            max_length=max_length,
+            return_attention_mask=False,
+            return_token_type_ids=False,
+        )["input_ids"]
+        for ids in encoded:
+            chunks.append(np.asarray(ids, dtype=np.int32))
+            lengths.append(len(ids))
+
+    batch = []
+    for text in texts:
+        batch.append(text)
+        if len(batch) == chunk_size:
+            encode(batch)
+            batch = []
+    if batch:
+        encode(batch)
+
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    input_ids = np.concatenate(chunks) if chunks else np.empty(0, dtype=np.int32)
+    return input_ids, offsets
+
+
+def pad_token_ids(sequences, pad_token_id=0, with_token_type_ids=True):
+    max_length = max(len(ids) for ids in sequences)
+    input_ids = torch.full((len(sequences), max_length), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(sequences), max_length), dtype=torch.long)
+    for i, ids in enumerate(sequences):
+        input_ids[i, : len(ids)] = torch.from_numpy(np.asarray(ids, dtype=np.int64))
+        attention_mask[i, : len(ids)] = 1
+    features = {"input_ids": input_ids, "attention_mask": attention_mask}
+    if with_token_type_ids:
+        features["token_type_ids"] = torch.zeros_like(input_ids)
+    return features
+
+
+def fingerprint_texts(texts):
+    digest = hashlib.sha1()
+    count = 0
+    for text in texts:
+        digest.update(text.encode("utf-8"))
+        digest.update(b"\0")
+        count += 1
+    return f"{count}-{digest.hexdigest()}"
+
+
+def fingerprint_tokenizer(tokenizer):
+    # Hash what the tokenizer does rather than its path, so fine-tuned
+    # checkpoints that ship the base model's tokenizer share one cache
+    if getattr(tokenizer, "is_fast", False):
+        definition = json.loads(tokenizer.backend_tokenizer.to_str())
+        # Truncation and padding are runtime state set by earlier calls
+        definition.pop("truncation", None)
+        definition.pop("padding", None)
+        definition = json.dumps(definition, sort_keys=True)
+    else:
+        definition = json.dumps(sorted(tokenizer.get_vocab().items()))
+    return hashlib.sha1(
+        f"{type(tokenizer).__name__}\0{transformers.__version__}\0{definition}".encode("utf-8")
+    ).hexdigest()
+
+
+def cache_key(tokenizer, max_length, corpus_fingerprint):
+    return hashlib.sha1(
+        json.dumps(
+            [
+                CACHE_FORMAT_VERSION,
+                fingerprint_tokenizer(tokenizer),
+                max_length,
+                corpus_fingerprint,
+            ]
+        ).encode("utf-8")
+    ).hexdigest()
+
+
+def load_or_build_token_cache(texts, tokenizer, max_length, cache_dir):
+    """
+    Returns memory-mapped (input_ids, offsets) for texts, tokenizing them only
+    when no cache exists for this tokenizer, max_length and corpus.
+
+    texts must be iterable twice: once to fingerprint, once to tokenize.
+    """
+    key = cache_key(tokenizer, max_length, fingerprint_texts(texts))
+    path = os.path.join(cache_dir, key)
+    if not os.path.isfile(os.path.join(path, "meta.json")):
+        print(f"Token cache miss, tokenizing into {path}")
+        input_ids, offsets = tokenize_corpus(texts, tokenizer, max_length)
+
+        # Write into a temporary directory and rename, so readers never see half a cache
+        tmp_path = f"{path}.tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        np.save(os.path.join(tmp_path, "input_ids.npy"), input_ids)
+        np.save(os.path.join(tmp_path, "offsets.npy"), offsets)
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump(
+                {
+                    "tokenizer": tokenizer.name_or_path,
+                    "transformers_version": transformers.__version__,
+                    "max_length": max_length,
+                    "num_texts": len(offsets) - 1,
+                    "num_tokens": len(input_ids),
+                },
+                f,
+                indent=2,
+            )
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+
+    return (
+        np.load(os.path.join(path, "input_ids.npy"), mmap_mode="r"),
+        np.load(os.path.join(path, "offsets.npy"), mmap_mode="r"),
+    )
@@ -1,17 +1,17 @@
 import sys
-import json
-from torch.utils.data import DataLoader
-from sentence_transformers import SentenceTransformer, LoggingHandler, util, models, evaluation, losses, InputExample
+from sentence_transformers import SentenceTransformer, LoggingHandler, util, models, evaluation, losses
 import logging
 from datetime import datetime
 import os
 from collections import defaultdict
 from torch.utils.data import IterableDataset
-import tqdm
 from torch.utils.data import Dataset
 import random
 import torch
 import transformers
+import numpy as np
+from loaders import LazyCorpus, iter_jsonl, load_tsv
+from train_data import PrefetchingDataLoader, StepTimer, TokenizingCollator
 
 # Disable Wandb
 os.environ["WANDB_DISABLED"] = "true"
@@ -35,13 +35,20 @@ model_name = 'sentence-transformers/msmarco-bert-base-dot-v5'  # Model name
 max_passages = 0  # Maximum passages
 epochs = 5  # Number of epochs
 pooling = 'mean'  # Pooling type - mean pooling is used for dot product model
-negs_to_use = 'custom'  # System for negative examples
+negs_to_use = 'custom'  # System for negative examples, e.g. 'dense-mined' written by mine_negatives.py
 warmup_steps = 100  # Reduced warmup steps
 lr = 1e-5  # Reduced learning rate
 name = 'custom_bert_dot_v5'  # Model name
 num_negs_per_system = 5  # Number of negative examples
+num_hard_negatives = 0  # Hard negatives per training example, drawn from the above; 0 uses in-batch negatives only
+loss_type = 'mnrl'  # 'mnrl' (MultipleNegativesRankingLoss) or 'margin_mse' (MarginMSELoss, needs real cross-encoder ce-scores)
 use_pre_trained_model = True  # Use pre-trained model
 use_all_queries = False  # Use all queries
+# Input pipeline: workers read and tokenize batches ahead of the training loop
+num_workers = min(4, os.cpu_count() or 1)
+prefetch_factor = 4  # Batches queued per worker
+pin_memory = torch.cuda.is_available()  # Page-locked batches copy to the GPU faster
+timing_report_steps = 500  # Print input vs compute time per step this often
 
 # Kaggle paths
 data_folder = '/kaggle/input/msmarcobase1'
@@ -54,8 +61,14 @@ print(f"Batch size: {train_batch_size}")
 print(f"Epochs: {epochs}")
 print(f"Learning rate: {lr}")
 print(f"Warmup steps: {warmup_steps}")
+print(f"Loss: {loss_type}, hard negatives per example: {num_hard_negatives}")
 print("==============================")
 
+if loss_type not in ('mnrl', 'margin_mse'):
+    raise ValueError(f"Unknown loss_type {loss_type!r}, expected 'mnrl' or 'margin_mse'")
+if loss_type == 'margin_mse' and num_hard_negatives < 1:
+    raise ValueError("loss_type 'margin_mse' needs num_hard_negatives >= 1")
+
 # Creating model
 if use_pre_trained_model:
     print(f"\nLoading pre-trained SBERT model: {model_name}")
@@ -71,48 +84,23 @@ else:
 os.makedirs(model_save_path, exist_ok=True)
 
 # Load corpus data
-corpus = {}
 collection_filepath = os.path.join(data_folder, 'collection.tsv')
 
 print("\nReading corpus: collection.tsv")
-with open(collection_filepath, 'r', encoding='utf8') as fIn:
-    # Find total number of lines
-    total_lines = sum(1 for _ in fIn)
-    fIn.seek(0)  # Return to start of file
-    
-    for line_num, line in tqdm.tqdm(enumerate(fIn, 1), total=total_lines, desc="Loading corpus"):
-        line = line.strip()
-        if not line:  # Skip empty lines
-            continue
-        parts = line.split("\t")
-        if len(parts) != 2:
-            print(f"Warning: Line {line_num} has incorrect format: {line}")
-            continue
-        pid, passage = parts
-        corpus[pid] = passage
+# Passages stay in the memory-mapped file; only the pid index is loaded
+corpus = LazyCorpus(collection_filepath, desc="Indexing corpus")
+for line_num, line in corpus.malformed:
+    print(f"Warning: Line {line_num} has incorrect format: {line}")
 
 print(f"Corpus loaded. Total number of documents: {len(corpus)}")
 
 # Training data: train queries
-queries = {}
 queries_filepath = os.path.join(data_folder, 'queries.train.tsv')
 
 print("\nReading queries: queries.train.tsv")
-with open(queries_filepath, 'r', encoding='utf8') as fIn:
-    # Find total number of lines
-    total_lines = sum(1 for _ in fIn)
-    fIn.seek(0)  # Return to start of file
-    
-    for line_num, line in tqdm.tqdm(enumerate(fIn, 1), total=total_lines, desc="Loading queries"):
-        line = line.strip()
-        if not line:  # Skip empty lines
-            continue
-        parts = line.split("\t")
-        if len(parts) != 2:
-            print(f"Warning: Line {line_num} has incorrect format: {line}")
-            continue
-        qid, query = parts
-        queries[qid] = query
+queries, malformed = load_tsv(queries_filepath, desc="Loading queries")
+for line_num, line in malformed:
+    print(f"Warning: Line {line_num} has incorrect format: {line}")
 
 print(f"Queries loaded. Total number of queries: {len(queries)}")
 
@@ -123,91 +111,162 @@ train_queries = {}
 ce_scores = {}
 
 print("\nLoading training data...")
-with open(train_filepath, 'rt') as fIn:
-    # Find total number of lines
-    total_lines = sum(1 for _ in fIn)
-    fIn.seek(0)  # Return to start of file
+for data in iter_jsonl(train_filepath, desc="Loading training data"):
+    if max_passages > 0 and len(train_queries) >= max_passages:
+        break
+        
+    if data['qid'] not in ce_scores:
+        ce_scores[data['qid']] = {}
     
-    for line in tqdm.tqdm(fIn, total=total_lines, desc="Loading training data"):
-        if max_passages > 0 and len(train_queries) >= max_passages:
-            break
+    # Positive ce_scores
+    for item in data['pos']:
+        ce_scores[data['qid']][item['pid']] = item['ce-score']
+
+    # Get positive passage IDs
+    pos_pids = [item['pid'] for item in data['pos']]
+   
+    # Get negative passages
+    neg_pids = set()
+    if negs_to_use not in data['neg']:
+        continue
             
-        data = json.loads(line)
-        
-        if data['qid'] not in ce_scores:
-            ce_scores[data['qid']] = {}
-        
-        # Positive ce_scores
-        for item in data['pos']:
-            ce_scores[data['qid']][item['pid']] = item['ce-score']
-
-        # Get positive passage IDs
-        pos_pids = [item['pid'] for item in data['pos']]
-       
-        # Get negative passages
-        neg_pids = set()
-        if negs_to_use not in data['neg']:
-            continue
-                
-        system_negs = data['neg'][negs_to_use]
+    system_negs = data['neg'][negs_to_use]
+    
+    negs_added = 0
+    for item in system_negs:
+        ce_scores[data['qid']][item['pid']] = item['ce-score']
         
-        negs_added = 0
-        for item in system_negs:
-            ce_scores[data['qid']][item['pid']] = item['ce-score']
-            
-            pid = item['pid']
-            if pid not in neg_pids:
-                neg_pids.add(pid)
-                negs_added += 1
-                if negs_added >= num_negs_per_system:
-                    break
+        pid = item['pid']
+        if pid not in neg_pids:
+            neg_pids.add(pid)
+            negs_added += 1
+            if negs_added >= num_negs_per_system:
+                break
 
-        if use_all_queries or (len(pos_pids) > 0 and len(neg_pids) > 0):
-            train_queries[data['qid']] = {'qid': data['qid'], 'query': queries[data['qid']], 'pos': pos_pids, 'neg': neg_pids}
+    if use_all_queries or (len(pos_pids) > 0 and len(neg_pids) > 0):
+        train_queries[data['qid']] = {'qid': data['qid'], 'query': queries[data['qid']], 'pos': pos_pids, 'neg': neg_pids}
 
 print(f"Training data loaded. Total number of training queries: {len(train_queries)}")
 
+if loss_type == 'margin_mse':
+    # convert_to_msmarco.py and mine_negatives.py write placeholder ce-scores (1.0 for
+    # positives, 0.0 for negatives), which give MarginMSE the same target margin for
+    # every pair and no signal from the scores
+    neg_scores = {
+        ce_scores[query_data['qid']][pid]
+        for query_data in train_queries.values()
+        for pid in query_data['neg']
+    }
+    if len(neg_scores) <= 1:
+        raise ValueError(
+            f"loss_type 'margin_mse' needs cross-encoder ce-scores, but every negative of system "
+            f"'{negs_to_use}' has ce-score {next(iter(neg_scores), None)}; score the pairs with a "
+            f"cross-encoder or use loss_type 'mnrl'"
+        )
+
 # Custom Dataset Class
 class MSMARCODataset(Dataset):
-    def __init__(self, queries, corpus):
-        self.queries = []
+    """
+    One example per query-positive pair, as ((query, positive), label) texts or,
+    with num_negatives, ((query, positive, negative 1, ..., negative k), label)
+    with k hard negatives drawn from the query's mined negatives.
+
+    Negatives are drawn again on every access, so each epoch pairs a positive
+    with other negatives (the DataLoader seeds random in every worker).
+    With ce_scores, the label is the cross-encoder margin score(positive) -
+    score(negative) of every negative (MarginMSELoss), otherwise 0.
+    """
+    def __init__(self, queries, corpus, num_negatives=0, ce_scores=None):
         self.corpus = corpus
+        self.num_negatives = num_negatives
+        self.with_margins = ce_scores is not None
+        self.query_texts = []
+        self.negatives = []  # Corpus rows of the negatives of every query
+        self.negative_scores = []
         
-        # Flatten data: Create an example for each query-positive pair
+        # Flatten data: one (query row, passage row) pair for each query-positive pair,
+        # the passage text is read from the memory-mapped corpus on access
+        query_rows = []
+        pos_pids = []
+        pos_scores = []
         for qid, query_data in queries.items():
-            query_text = query_data['query']
-            # Create an entry for each positive example
-            for pos_pid in query_data['pos']:
-                if pos_pid in corpus:  
-                    self.queries.append({
-                        'query': query_text,
-                        'positive': corpus[pos_pid]
-                    })
+            scores = ce_scores.get(qid, {}) if self.with_margins else {}
+            neg_pids = list(query_data['neg'])
+            neg_rows = corpus.rows(neg_pids)
+            found = neg_rows >= 0
+            if num_negatives > 0 and not found.any():
+                continue  # No negatives to draw from
+            query_rows.extend([len(self.query_texts)] * len(query_data['pos']))
+            pos_pids.extend(query_data['pos'])
+            pos_scores.extend(scores.get(pid, 0.0) for pid in query_data['pos'])
+            self.query_texts.append(query_data['query'])
+            self.negatives.append(neg_rows[found])
+            self.negative_scores.append(
+                np.asarray([scores.get(pid, 0.0) for pid in neg_pids], dtype=np.float32)[found]
+            )
+        passage_rows = corpus.rows(pos_pids)
+        found = passage_rows >= 0  # Skip positives missing from the corpus
+        self.pairs = np.stack([np.asarray(query_rows, dtype=np.int64)[found], passage_rows[found]], axis=1)
+        self.pos_scores = np.asarray(pos_scores, dtype=np.float32)[found]
 
     def __getitem__(self, idx):
-        query_data = self.queries[idx]
-        return InputExample(texts=[query_data['query'], query_data['positive']])
+        # Raw texts; TokenizingCollator turns a batch of them into token ids in the workers
+        query_row, passage_row = self.pairs[idx]
+        texts = [self.query_texts[query_row], self.corpus.passage(passage_row)]
+        if not self.num_negatives:
+            return tuple(texts), 0
+        negatives = self.negatives[query_row]
+        if len(negatives) >= self.num_negatives:
+            picks = random.sample(range(len(negatives)), self.num_negatives)
+        else:
+            # Too few mined negatives: repeat some, so all examples have the same columns
+            picks = random.choices(range(len(negatives)), k=self.num_negatives)
+        texts.extend(self.corpus.passage(negatives[pick]) for pick in picks)
+        if not self.with_margins:
+            return tuple(texts), 0
+        margins = [float(self.pos_scores[idx] - self.negative_scores[query_row][pick]) for pick in picks]
+        # A single margin stays a scalar, the label shape MarginMSELoss has always accepted
+        return tuple(texts), margins[0] if len(margins) == 1 else margins
 
     def __len__(self):
-        return len(self.queries)
+        return len(self.pairs)
 
 # DataLoader and Loss function
 print("\nPreparing DataLoader...")
-train_dataset = MSMARCODataset(queries=train_queries, corpus=corpus)
-train_dataloader = DataLoader(
+train_dataset = MSMARCODataset(
+    queries=train_queries,
+    corpus=corpus,
+    num_negatives=num_hard_negatives,
+    ce_scores=ce_scores if loss_type == 'margin_mse' else None
+)
+step_timer = StepTimer(report_every=timing_report_steps)
+train_dataloader = PrefetchingDataLoader(
     train_dataset, 
     shuffle=True, 
     batch_size=train_batch_size, 
     drop_last=True,
-    num_workers=0
+    num_workers=num_workers,
+    collate_fn=TokenizingCollator.for_model(model),
+    pin_memory=pin_memory,
+    prefetch_factor=prefetch_factor if num_workers > 0 else None,
+    persistent_workers=num_workers > 0,
+    timer=step_timer
 )
 
 # Loss function
-train_loss = losses.MultipleNegativesRankingLoss(
-    model=model,
-    scale=20.0, 
-    similarity_fct=util.dot_score 
-)
+if loss_type == 'margin_mse':
+    # Regresses the dot-product margins onto the cross-encoder margins of the labels
+    train_loss = losses.MarginMSELoss(
+        model=model,
+        similarity_fct=util.pairwise_dot_score
+    )
+else:
+    # In-batch negatives, plus the hard negatives of the whole batch as extra candidates
+    train_loss = losses.MultipleNegativesRankingLoss(
+        model=model,
+        scale=20.0, 
+        similarity_fct=util.dot_score 
+    )
 
 class TrainingProgress:
     def __init__(self, total_epochs):
@@ -257,9 +316,13 @@ try:
     print(f"Batch size: {train_batch_size}")
     print(f"Total number of batches (per epoch): {len(train_dataloader)}")
     print(f"Total number of steps: {epochs * len(train_dataloader)}")
+    print(f"DataLoader workers: {num_workers}, prefetch factor: {prefetch_factor}, pin memory: {pin_memory}")
     print("=====================")
     
-    model.fit(
+    # fit in sentence-transformers v3+ rebuilds the training data from the dataset and
+    # bypasses the DataLoader; old_fit is the v2 training loop, which iterates it
+    fit = getattr(model, 'old_fit', model.fit)
+    fit(
         train_objectives=[(train_dataloader, train_loss)],
         epochs=epochs,
         warmup_steps=warmup_steps,
@@ -297,6 +360,8 @@ print(f"Total number of documents: {len(corpus)}")
 print(f"Total number of queries: {len(queries)}")
 print(f"Total training queries: {len(train_queries)}")
 print(f"Best loss: {progress_tracker.best_loss:.4f}")
+timing = step_timer.summary()
+print(f"Input time per step: {timing['input_ms_per_step']:.1f} ms, compute time per step: {timing['compute_ms_per_step']:.1f} ms")
 print(f"Model save path: {model_save_path}")
 if torch.cuda.is_available():
     print(f"Final GPU Memory Usage: {torch.cuda.memory_allocated()/1024**2:.1f}MB")
@@ -2,11 +2,10 @@ import pickle
 import random
 import json
 import os
+from docstore import DocumentStore
 
 # Load your dataset
 data_path = "../data"
-with open(f"{data_path}/docs.pkl", "rb") as f:
-    documents = pickle.load(f)
 
 with open(f"{data_path}/queriesTrainWithNonRelevant.pkl", "rb") as f:
     train_queries = pickle.load(f)
@@ -14,32 +13,38 @@ with open(f"{data_path}/queriesTrainWithNonRelevant.pkl", "rb") as f:
 with open(f"{data_path}/queriesTestWithNonRelevant.pkl", "rb") as f:
     test_queries = pickle.load(f)
 
-# Debug: Print first few documents to understand structure
+docstore = DocumentStore(f"{data_path}/docstore")
+
+# Debug: Print the first document to understand structure
 print("Debug: First document structure:")
-first_doc = documents[0]
-print(f"Doc attributes: {dir(first_doc)}")
+first_doc = docstore[0]
+print(f"Doc store columns: {docstore.columns}")
 print(f"Doc no: {first_doc.doc_no}")
 print(f"Headline: {first_doc.headline}")
 print(f"Text: {first_doc.text[:100] if first_doc.text else None}")
 
 # Convert to MS MARCO format
-# 1. Create corpus dictionary (pid -> passage)
+# 1. Create corpus dictionary (pid -> passage), reading only the columns we need
 corpus = {}
-for doc in documents:
+for doc_no, headline, doc_text in zip(
+    docstore.iter_column("doc_no"),
+    docstore.iter_column("headline"),
+    docstore.iter_column("text"),
+):
     # Combine headline and text if both exist
     text = ""
-    if doc.headline:
-        text += doc.headline + " "
-    if doc.text:
-        text += doc.text
+    if headline:
+        text += headline + " "
+    if doc_text:
+        text += doc_text
     
     # Clean the text: remove tabs and newlines to ensure proper TSV format
     text = text.strip().replace("\t", " ").replace("\n", " ")
     if not text:  # Skip empty documents
-        print(f"Warning: Empty text for document {doc.doc_no}")
+        print(f"Warning: Empty text for document {doc_no}")
         continue
         
-    corpus[doc.doc_no] = text
+    corpus[doc_no] = text
 
 # 2. Create train and test queries dictionaries
 train_queries_dict = {}
@@ -53,6 +58,25 @@ for query in test_queries:
     test_queries_dict[query.query_no] = clean_query
 
 # 3. Create training data structure
+all_doc_ids = list(corpus.keys())
+
+
+def sample_random_negatives(pos_pids, num_negs=100):
+    # Rejection sampling from the id list built once, instead of the set of all
+    # other documents for every query; positives are rare among the draws
+    excluded = {pid for pid in pos_pids if pid in corpus}
+    num_negs = min(len(all_doc_ids) - len(excluded), num_negs)
+    if num_negs * 2 > len(all_doc_ids) - len(excluded):
+        # Draws would mostly repeat in a corpus barely larger than the sample
+        return random.sample([pid for pid in all_doc_ids if pid not in excluded], num_negs)
+    neg_pids = {}
+    while len(neg_pids) < num_negs:
+        pid = random.choice(all_doc_ids)
+        if pid not in excluded:
+            neg_pids[pid] = None
+    return list(neg_pids)
+
+
 train_data = {}
 for query in train_queries:
     qid = query.query_no
@@ -69,11 +93,9 @@ for query in train_queries:
     else:
         # Fallback to random sampling if no non-relevant docs available
         print(f"Warning: No non-relevant documents found for query {qid}, using random sampling.")
-        all_doc_ids = set(corpus.keys())
-        available_negs = list(all_doc_ids - set(pos_pids))
         # Use a reasonable number of random negatives as fallback
-        num_negs = min(len(available_negs), 100)
-        neg_pids = random.sample(available_negs, num_negs)
+        # (mine_negatives.py adds retrieved hard negatives afterwards)
+        neg_pids = sample_random_negatives(pos_pids, 100)
     
     train_data[qid] = {
         'qid': qid,
@@ -126,7 +148,7 @@ with open(os.path.join(output_dir, 'test.qrels'), 'w', encoding='utf8') as f:
         qid = query.query_no
         # Save relevant documents
         for doc_id in query.relevant_docs:
-            f.write(f"{qid}\t0\t{doc_id}\t1\n")
+            f.write(f"{qid}\t0\t{doc_id}\t{query.get_relevance(doc_id)}\n")
         # Save non-relevant documents
         if query.non_relevant_docs:
             for doc_id in query.non_relevant_docs:
@@ -1,33 +1,47 @@
 import os
 import json
+import hashlib
 import torch
 import numpy as np
 from tqdm import tqdm
 from sentence_transformers import SentenceTransformer
 import pytrec_eval
-import time
-from datetime import datetime, timedelta
-
-# FAISS import
-try:
-    import faiss
-    print("FAISS GPU version loaded successfully!")
-except ImportError:
-    try:
-        import faiss.contrib.torch_utils
-        print("FAISS CPU version loaded successfully!")
-    except ImportError:
-        raise ImportError("FAISS could not be loaded. Please run 'pip install faiss-gpu' or 'pip install faiss-cpu'")
+from datetime import timedelta
+from token_cache import load_or_build_token_cache, pad_token_ids
+from inference import metric_drift, model_fingerprint, prepare_model, print_drift
+from run import Run
+from query_cache import QueryCache, fingerprint
+from loaders import iter_lines, load_tsv
+from evaluation import Evaluator, per_query
+from ann_index import build_index, index_file_name, index_manifest, load_valid_index, save_index, set_search_params
 
 def format_time(seconds):
     return str(timedelta(seconds=int(seconds)))
 
+
+def report_malformed(error_lines):
+    if error_lines:
+        print(f"\nError line count: {len(error_lines)}")
+        print("First 5 error line examples:")
+        for line_num, line in error_lines[:5]:
+            print(f"Line {line_num}: {line[:100]}...")  # Show first 100 characters
+
 # Configuration
 model_path = '/kaggle/working/train_bi-encoder-margin_mse_en-custom_bert_dot_v5-sentence-transformers-msmarco-bert-base-dot-v5-batch_size_8-2025-01-15_15-47-06'  # Trained model path
 data_folder = 'msmarco-data'  # Changed to msmarco-data folder
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 batch_size = 32
 top_k = 1000  # Sufficient results for Recall@1000
+token_cache_path = os.path.join(data_folder, 'token_cache')  # Token ids reused across checkpoints
+precision = 'fp32'  # 'bf16' or 'int8' for faster CPU inference
+check_precision_drift = True  # Also evaluate fp32 and report nDCG@10/MAP drift when precision != 'fp32'
+index_type = 'flat'  # Exact; or 'ivf_flat', 'ivf_pq', 'hnsw', 'opq_ivf_pq' (see ann_index.py)
+index_params = {}  # e.g. {'nlist': 4096, 'pq_m': 64} or {'hnsw_m': 32}
+search_params = {}  # e.g. {'nprobe': 64} or {'ef_search': 256}
+index_dir = os.path.join(data_folder, 'faiss_index')  # Persisted document index, None to disable
+run_file = 'evaluation_run.trec'  # TREC run file of the search results
+query_cache_dir = os.path.join(data_folder, 'query_cache')  # Query embeddings and results reused across runs, None to disable
+use_native_evaluator = True  # NumPy evaluator on the run arrays (matches pytrec_eval to 1e-6), False for pytrec_eval
 
 print(f"Device: {device}")
 
@@ -36,73 +50,22 @@ print("Loading model...")
 model = SentenceTransformer(model_path)
 model.to(device)
 model.eval()
+encoder = prepare_model(model, precision)
 
 # Loading documents
 print("\nLoading documents...")
-corpus = {}
-error_lines = []
-total_lines = 0
-valid_lines = 0
-
-with open(os.path.join(data_folder, 'collection.tsv'), 'r', encoding='utf8') as f:
-    for line_num, line in enumerate(tqdm(f, desc="Reading documents"), 1):
-        total_lines += 1
-        line = line.strip()
-        if not line:  # Skip empty lines
-            continue
-            
-        parts = line.split('\t')
-        if len(parts) != 2:
-            error_lines.append(f"Line {line_num}: {line[:100]}...")  # Show first 100 characters
-            continue
-            
-        pid, passage = parts
-        if pid and passage:  # If both fields are non-empty
-            corpus[pid] = passage
-            valid_lines += 1
-
-print(f"\nTotal lines: {total_lines}")
-print(f"Valid document count: {valid_lines}")
-if error_lines:
-    print(f"\nError line count: {len(error_lines)}")
-    print("First 5 error line examples:")
-    for err in error_lines[:5]:
-        print(err)
+corpus, error_lines = load_tsv(os.path.join(data_folder, 'collection.tsv'), desc="Reading documents")
+print(f"\nValid document count: {len(corpus)}")
+report_malformed(error_lines)
 
 if not corpus:
     raise ValueError("No valid documents loaded! Please check file format.")
 
 # Loading test queries instead of train queries
 print("\nLoading test queries...")
-queries = {}
-error_lines = []
-total_lines = 0
-valid_lines = 0
-
-with open(os.path.join(data_folder, 'queries.test.tsv'), 'r', encoding='utf8') as f:
-    for line_num, line in enumerate(tqdm(f, desc="Reading queries"), 1):
-        total_lines += 1
-        line = line.strip()
-        if not line:  # Skip empty lines
-            continue
-            
-        parts = line.split('\t')
-        if len(parts) != 2:
-            error_lines.append(f"Line {line_num}: {line[:100]}...")
-            continue
-            
-        qid, query = parts
-        if qid and query:  # If both fields are non-empty
-            queries[qid] = query
-            valid_lines += 1
-
-print(f"\nTotal lines: {total_lines}")
-print(f"Valid query count: {valid_lines}")
-if error_lines:
-    print(f"\nError line count: {len(error_lines)}")
-    print("First 5 error line examples:")
-    for err in error_lines[:5]:
-        print(err)
+queries, error_lines = load_tsv(os.path.join(data_folder, 'queries.test.tsv'), desc="Reading queries")
+print(f"\nValid query count: {len(queries)}")
+report_malformed(error_lines)
 
 if not queries:
     raise ValueError("No valid queries loaded! Please check file format.")
@@ -110,54 +73,173 @@ if not queries:
 # Loading ground truth from test.qrels instead of msmarco-hard-negatives.jsonl
 print("\nLoading ground truth...")
 qrels = {}
-with open(os.path.join(data_folder, 'test.qrels'), 'r') as f:
-    for line in tqdm(f, desc="Reading ground truth"):
-        qid, _, doc_id, relevance = line.strip().split('\t')
-        if qid not in qrels:
-            qrels[qid] = {}
-        qrels[qid][doc_id] = int(relevance)
-
-# Encoding documents
-print("\nEncoding documents...")
+for line in iter_lines(os.path.join(data_folder, 'test.qrels'), desc="Reading ground truth"):
+    if not line.strip():
+        continue
+    qid, _, doc_id, relevance = line.strip().split('\t')
+    if qid not in qrels:
+        qrels[qid] = {}
+    qrels[qid][doc_id] = int(relevance)
+
+def prepare_texts(texts):
+    # Same preprocessing as SentenceTransformer.tokenize
+    texts = [text.strip() for text in texts]
+    if getattr(model[0], 'do_lower_case', False):
+        texts = [text.lower() for text in texts]
+    return texts
+
+
+def encode_cached(texts, desc, encoder=encoder):
+    # Tokenize through the on-disk cache, then run the model on the cached ids
+    input_ids, offsets = load_or_build_token_cache(
+        prepare_texts(texts), model.tokenizer, model.max_seq_length, token_cache_path
+    )
+    return encode_token_ids(input_ids, offsets, desc, encoder)
+
+
+def encode_token_ids(input_ids, offsets, desc, encoder=encoder, rows=None):
+    # Embeddings of the given rows (all by default) of ragged token ids, in that order
+    rows = np.arange(len(offsets) - 1) if rows is None else np.asarray(rows, dtype=np.int64)
+    with_token_type_ids = 'token_type_ids' in model.tokenizer.model_input_names
+    # Encode in length order to reduce padding, then restore the input order
+    order = np.argsort(-(offsets[rows + 1] - offsets[rows]), kind='stable')
+    embeddings = None
+    for i in tqdm(range(0, len(order), batch_size), desc=desc):
+        positions = order[i:i + batch_size]
+        features = pad_token_ids(
+            [input_ids[offsets[row]:offsets[row + 1]] for row in rows[positions]],
+            model.tokenizer.pad_token_id,
+            with_token_type_ids,
+        )
+        features = {key: value.to(device) for key, value in features.items()}
+        with torch.no_grad():
+            batch_embeddings = encoder(features)['sentence_embedding'].float().cpu().numpy()
+        if embeddings is None:
+            embeddings = np.empty((len(order), batch_embeddings.shape[1]), dtype=np.float32)
+        embeddings[positions] = batch_embeddings
+    return embeddings
+
+
+def pooling_mode(model):
+    for module in model:
+        if hasattr(module, 'pooling_mode'):
+            return module.pooling_mode
+        if hasattr(module, 'get_pooling_mode_str'):
+            return module.get_pooling_mode_str()
+    return None
+
+
+def create_index(doc_embeddings, index_path=None, manifest=None):
+    # Creating FAISS index (inner product, as the model was trained with dot product)
+    print("\nCreating FAISS index...")
+    index = build_index(doc_embeddings, index_type, normalize=False, **index_params)
+    if index_path:
+        save_index(index, index_path, manifest)
+    return index
+
+
 doc_ids = list(corpus.keys())
 doc_texts = [corpus[did] for did in doc_ids]
 
-doc_embeddings = []
-for i in tqdm(range(0, len(doc_texts), batch_size), desc="Document encoding"):
-    batch_texts = doc_texts[i:i + batch_size]
-    with torch.no_grad():
-        embeddings = model.encode(batch_texts, convert_to_tensor=True, show_progress_bar=False)
-        doc_embeddings.append(embeddings.cpu().numpy())
-doc_embeddings = np.vstack(doc_embeddings)
+# A persisted index is memory-mapped instead of re-encoding the corpus, as long
+# as it was built from the same model, pooling, precision and documents
+model_hash = model_fingerprint(model_path)
+index_path = None
+expected_manifest = None
+index = None
+if index_dir:
+    os.makedirs(index_dir, exist_ok=True)
+    expected_manifest = index_manifest(
+        index_type,
+        index_params,
+        any(type(module).__name__ == 'Normalize' for module in model),
+        len(doc_ids),
+        model_hash=model_hash,
+        pooling=pooling_mode(model),
+        precision=precision,
+        max_seq_length=model.max_seq_length,
+        ids_sha1=hashlib.sha1('\n'.join(doc_ids).encode('utf-8')).hexdigest(),
+    )
+    index_path = os.path.join(index_dir, index_file_name(expected_manifest))
+    index = load_valid_index(index_path, expected_manifest)
+if index is not None:
+    print(f"\nMemory-mapped {index_path}, skipping document encoding")
+else:
+    # Encoding documents
+    print("\nEncoding documents...")
+    doc_embeddings = encode_cached(doc_texts, "Document encoding")
+    index = create_index(doc_embeddings, index_path, expected_manifest)
+
+
+# Repeated queries skip encoding, and searching when the index has a manifest
+# to key the results on
+query_cache = None
+if query_cache_dir:
+    query_cache = QueryCache(
+        fingerprint({
+            'model_hash': model_hash,
+            'pooling': pooling_mode(model),
+            'precision': precision,
+            'max_seq_length': model.max_seq_length,
+        }),
+        fingerprint({'index': expected_manifest, 'search_params': search_params}) if expected_manifest else None,
+        disk_dir=query_cache_dir,
+    )
+
+
+def search(index, query_embeddings, cache=None):
+    set_search_params(index, **search_params)
+
+    def search_batches(embeddings, k):
+        # FAISS returns every row sorted by score, so the run keeps the arrays as they are
+        scores = np.empty((len(embeddings), k), dtype=np.float32)
+        indices = np.empty((len(embeddings), k), dtype=np.int64)
+        for i in tqdm(range(0, len(embeddings), batch_size), desc="Query search"):
+            scores[i:i + batch_size], indices[i:i + batch_size] = index.search(
+                embeddings[i:i + batch_size], k
+            )
+        return scores, indices
+
+    if cache is None:
+        scores, indices = search_batches(query_embeddings, top_k)
+    else:
+        results = cache.search(query_embeddings, [top_k] * len(query_embeddings), search_batches)
+        scores = np.stack([row_scores for row_scores, _ in results])
+        indices = np.stack([row_indices for _, row_indices in results])
+    return Run(query_ids, doc_ids, scores, indices)
 
-# Creating FAISS index
-print("\nCreating FAISS index...")
-dimension = doc_embeddings.shape[1]
-index = faiss.IndexFlatIP(dimension)  # For inner product
-index.add(doc_embeddings)
 
 # Encoding queries and performing search
 print("\nEncoding queries and performing search...")
-results = {}
 query_ids = list(queries.keys())
 query_texts = [queries[qid] for qid in query_ids]
 
-for i in tqdm(range(0, len(query_texts), batch_size), desc="Query search"):
-    batch_texts = query_texts[i:i + batch_size]
-    batch_ids = query_ids[i:i + batch_size]
-    
-    with torch.no_grad():
-        q_embeddings = model.encode(batch_texts, convert_to_tensor=True, show_progress_bar=False)
-        scores, indices = index.search(q_embeddings.cpu().numpy(), top_k)
-        
-        # Save results for each query
-        for qid, query_scores, query_indices in zip(batch_ids, scores, indices):
-            results[qid] = {doc_ids[idx]: float(score) for idx, score in zip(query_indices, query_scores)}
+if query_cache is None:
+    query_embeddings = encode_cached(query_texts, "Query encoding")
+else:
+    # All queries are tokenized once through the token cache and only the rows
+    # missing from the query cache are encoded; tokenizing just the misses
+    # would add a token cache entry for every different set of misses
+    query_token_ids, query_offsets = load_or_build_token_cache(
+        prepare_texts(query_texts), model.tokenizer, model.max_seq_length, token_cache_path
+    )
+    query_rows = {text: row for row, text in enumerate(query_texts)}
+
+    def encode_query_misses(texts):
+        return encode_token_ids(
+            query_token_ids, query_offsets, "Query encoding", rows=[query_rows[text] for text in texts]
+        )
+
+    query_embeddings = query_cache.encode(query_texts, encode_query_misses)
+run = search(index, query_embeddings, query_cache)
+if query_cache is not None:
+    for level, level_stats in query_cache.stats().items():
+        print(f"Query cache ({level}): {level_stats['hits'] + level_stats['disk_hits']} hits, "
+              f"{level_stats['misses']} misses")
+run.write_trec(run_file, system=os.path.basename(model_path.rstrip('/')))
 
 # Prepare qrels format for evaluation
 trec_qrels = {qid: {pid: rel for pid, rel in rels.items()} for qid, rels in qrels.items()}
-trec_results = {qid: {pid: score for pid, score in sorted(res.items(), key=lambda x: x[1], reverse=True)} 
-                for qid, res in results.items()}
 
 # Define metrics
 metrics_dict = {
@@ -186,9 +268,20 @@ metrics_dict = {
     "bpref": "Binary Preference",
 }
 
-# Evaluation with pytrec_eval
-evaluator = pytrec_eval.RelevanceEvaluator(trec_qrels, set(metrics_dict.keys()))
-scores = evaluator.evaluate(trec_results)
+# Evaluation, per query as {qid: {metric: score}}
+if use_native_evaluator:
+    evaluator = Evaluator(trec_qrels, doc_ids)
+else:
+    evaluator = pytrec_eval.RelevanceEvaluator(trec_qrels, set(metrics_dict.keys()))
+
+
+def evaluate_run(run):
+    if use_native_evaluator:
+        return per_query(*evaluator.evaluate(run, metrics_dict.keys()))
+    return evaluator.evaluate(run.to_dict())
+
+
+scores = evaluate_run(run)
 
 # Print results
 metrics_values = {metric: [] for metric in metrics_dict.keys()}
@@ -205,6 +298,19 @@ for metric, values in metrics_values.items():
         mean_score = np.mean(values)
         print(f"{metrics_dict[metric]:<40} {mean_score:.4f}")
 
+# Retrieval metric drift against fp32, to decide whether the reduced precision is worth it
+if precision != 'fp32' and check_precision_drift:
+    print(f"\nEncoding with the fp32 model to measure the drift of {precision}...")
+    baseline_scores = evaluate_run(search(
+        create_index(encode_cached(doc_texts, "Document encoding (fp32)", model)),
+        encode_cached(query_texts, "Query encoding (fp32)", model),
+    ))
+    print_drift(metric_drift(
+        {metric: np.mean([query_scores[metric] for query_scores in baseline_scores.values()])
+         for metric in metrics_dict},
+        {metric: np.mean(values) for metric, values in metrics_values.items() if values},
+    ), precision)
+
 # Save detailed results
 print("\nSaving detailed results...")
 with open('evaluation_results.json', 'w') as f:
@@ -221,4 +327,4 @@ print(f"Total number of documents: {len(corpus)}")
 print(f"Number of evaluated queries: {len(scores)}")
 print(f"Number of results returned per query: {top_k}")
 
-print("\nEvaluation completed! Results saved to 'evaluation_results.json'") 
\ No newline at end of file
+print(f"\nEvaluation completed! Results saved to 'evaluation_results.json' and '{run_file}'") 
\ No newline at end of file
@@ -0,0 +1,220 @@
+import re
+
+import numpy as np
+
+# The 11 recall levels of trec_eval's interpolated precision curve
+RECALL_LEVELS = tuple(f"{level / 10:.2f}" for level in range(11))
+DEFAULT_METRICS = (
+    "map",
+    "ndcg_cut_10",
+    "ndcg_cut_20",
+    "P_5",
+    "P_10",
+    "P_20",
+    "P_100",
+    "recall_100",
+    "recall_1000",
+    "recip_rank",
+    *(f"iprec_at_recall_{level}" for level in RECALL_LEVELS),
+    "Rprec",
+    "bpref",
+)
+CUTOFF_PATTERN = re.compile(r"(P|recall|ndcg_cut)_(\d+)$")
+# Label of unjudged documents in the dense relevance matrix
+UNJUDGED = np.iinfo(np.int16).min
+
+
+class Evaluator:
+    """
+    Computes trec_eval measures (as pytrec_eval names them) on Run arrays.
+
+    Qrels are stored once over the corpus rows of the judged documents, as
+    a dense (queries x docs) int16 relevance matrix when it fits in
+    max_dense_cells, otherwise as sorted CSR keys. A run is scored by looking
+    up the labels of its (queries x top_k) index matrix and reducing along
+    the rank axis, without building a dict per hit. Judged documents missing
+    from doc_ids still count as relevant (or judged non-relevant) for recall,
+    MAP, R-prec, bpref and the ideal DCG, like in trec_eval.
+    """
+
+    def __init__(self, qrels, doc_ids, relevance_level=1, max_dense_cells=1 << 26):
+        self.relevance_level = relevance_level
+        self.num_docs = len(doc_ids)
+        row_of = {doc_id: row for row, doc_id in enumerate(doc_ids)}
+        # trec_eval breaks score ties by doc id, descending
+        self.doc_id_rank = np.empty(len(doc_ids), dtype=np.int64)
+        self.doc_id_rank[np.argsort(np.asarray(doc_ids, dtype=object), kind="stable")] = np.arange(
+            len(doc_ids)
+        )
+
+        self.query_ids = list(qrels)
+        self.query_row = {query_id: row for row, query_id in enumerate(self.query_ids)}
+        keys = []
+        labels = []
+        self.num_rel = np.zeros(len(self.query_ids), dtype=np.int64)
+        self.num_nonrel = np.zeros(len(self.query_ids), dtype=np.int64)
+        gains = []
+        for query_row, query_id in enumerate(self.query_ids):
+            judgments = qrels[query_id]
+            query_labels = np.fromiter(judgments.values(), dtype=np.float64, count=len(judgments))
+            self.num_rel[query_row] = np.count_nonzero(query_labels >= relevance_level)
+            # Negative labels count as unjudged, like in trec_eval
+            self.num_nonrel[query_row] = np.count_nonzero(
+                (query_labels >= 0) & (query_labels < relevance_level)
+            )
+            gains.append(np.sort(query_labels[query_labels > 0])[::-1])
+            for doc_id, label in judgments.items():
+                row = row_of.get(doc_id)
+                if row is not None:
+                    keys.append(query_row * self.num_docs + row)
+                    labels.append(label)
+        order = np.argsort(keys)
+        self.keys = np.asarray(keys, dtype=np.int64)[order]
+        self.labels = np.asarray(labels, dtype=np.float64)[order]
+        self.matrix = None
+        if len(self.query_ids) * self.num_docs <= max_dense_cells:
+            self.matrix = np.full((len(self.query_ids), self.num_docs), UNJUDGED, dtype=np.int16)
+            self.matrix.flat[self.keys] = self.labels
+
+        # Gains of every query sorted best first, for the ideal DCG
+        max_judged = max((len(query_gains) for query_gains in gains), default=0)
+        self.ideal_gains = np.zeros((len(self.query_ids), max_judged))
+        for query_row, query_gains in enumerate(gains):
+            self.ideal_gains[query_row, : len(query_gains)] = query_gains
+
+    def retrieved_labels(self, run, query_rows, run_rows, break_ties=True):
+        """
+        Returns the (queries x top_k) labels of the ranked hits of run, NaN
+        for unjudged documents and padding.
+        """
+        indices = run.indices[run_rows]
+        if break_ties:
+            # Score descending, then doc id descending, as trec_eval ranks.
+            # Hits are already sorted by score, so only rows with ties are
+            # sorted again, on one key: (run of equal scores, doc id rank)
+            scores = run.scores[run_rows]
+            changed = scores[:, 1:] != scores[:, :-1]
+            tied = np.flatnonzero(~changed.all(1))
+            if len(tied):
+                tied_indices = indices[tied]
+                tie_rank = np.where(
+                    tied_indices >= 0, self.doc_id_rank[np.maximum(tied_indices, 0)], -1
+                )
+                group = np.zeros(tied_indices.shape, dtype=np.int64)
+                np.cumsum(changed[tied], axis=1, out=group[:, 1:])
+                order = np.argsort(group * (self.num_docs + 1) + (self.num_docs - tie_rank), axis=1)
+                indices = indices.copy()
+                indices[tied] = np.take_along_axis(tied_indices, order, axis=1)
+
+        if self.matrix is not None:
+            # take on the flat matrix is about twice as fast as 2-d fancy indexing
+            labels = self.matrix.ravel().take(query_rows[:, None] * self.num_docs + np.maximum(indices, 0))
+            return np.where((indices >= 0) & (labels != UNJUDGED), labels, np.nan)
+
+        keys = query_rows[:, None] * self.num_docs + indices
+        positions = np.clip(np.searchsorted(self.keys, keys), 0, max(len(self.keys) - 1, 0))
+        found = (indices >= 0) & (len(self.keys) > 0)
+        if len(self.keys):
+            found &= self.keys[positions] == keys
+        return np.where(found, self.labels[positions] if len(self.labels) else 0.0, np.nan)
+
+    def evaluate(self, run, metrics=DEFAULT_METRICS, break_ties=True):
+        """
+        Scores every query of run that has qrels.
+
+        Returns:
+            (query_ids, {metric: per-query values in query_ids order})
+        """
+        run_rows = np.array(
+            [row for row, query_id in enumerate(run.query_ids) if query_id in self.query_row],
+            dtype=np.int64,
+        )
+        query_ids = [run.query_ids[row] for row in run_rows]
+        query_rows = np.array([self.query_row[query_id] for query_id in query_ids], dtype=np.int64)
+        labels = self.retrieved_labels(run, query_rows, run_rows, break_ties)
+        num_queries, top_k = labels.shape
+
+        relevant = labels >= self.relevance_level
+        # Judged non-relevant only: NaN compares False and negative labels are unjudged
+        nonrelevant = (labels >= 0) & (labels < self.relevance_level)
+        num_rel = self.num_rel[query_rows]
+        safe_num_rel = np.maximum(num_rel, 1)
+        has_rel = num_rel > 0
+
+        # Relevant hits are few, so the measures are reduced over their
+        # (query, rank) positions rather than over the whole label matrix.
+        # nonzero is row-major: the hits of a query are in rank order
+        hit_rows, hit_cols = np.nonzero(relevant)
+        num_hits = np.bincount(hit_rows, minlength=num_queries)
+        hit_starts = np.zeros(num_queries + 1, dtype=np.int64)
+        np.cumsum(num_hits, out=hit_starts[1:])
+        # Precision at the rank of every relevant hit
+        hit_precision = (np.arange(len(hit_rows)) - hit_starts[hit_rows] + 1) / (hit_cols + 1)
+
+        def relevant_at(cutoff):
+            return np.bincount(hit_rows[hit_cols < cutoff], minlength=num_queries)
+
+        def sum_per_query(values):
+            return np.bincount(hit_rows, values, minlength=num_queries)
+
+        results = {}
+        for metric in metrics:
+            match = CUTOFF_PATTERN.match(metric)
+            if metric == "map":
+                values = sum_per_query(hit_precision) / safe_num_rel
+            elif metric == "recip_rank":
+                first = hit_cols[np.minimum(hit_starts[:-1], len(hit_cols) - 1)] if len(hit_cols) else 0
+                values = np.where(num_hits > 0, 1.0 / (first + 1), 0.0)
+            elif metric == "Rprec":
+                values = relevant_at(num_rel[hit_rows]) / safe_num_rel
+            elif metric == "bpref":
+                # Judged non-relevant hits ranked above every relevant hit
+                nonrel_rows, nonrel_cols = np.nonzero(nonrelevant)
+                nonrel_keys = nonrel_rows * top_k + nonrel_cols
+                nonrel_above = np.searchsorted(nonrel_keys, hit_rows * top_k + hit_cols) - np.searchsorted(
+                    nonrel_keys, hit_rows * top_k
+                )
+                hit_num_rel = num_rel[hit_rows]
+                denominator = np.maximum(np.minimum(self.num_nonrel[query_rows][hit_rows], hit_num_rel), 1)
+                values = sum_per_query(1.0 - np.minimum(nonrel_above, hit_num_rel) / denominator) / safe_num_rel
+            elif metric.startswith("iprec_at_recall_"):
+                level = float(metric[len("iprec_at_recall_") :]) - 1e-12
+                # Relevant hits needed to reach the recall level (at least the first)
+                needed = np.ceil(level * safe_num_rel)
+                needed = np.where((needed - 1) / safe_num_rel >= level, needed - 1, needed)
+                needed = np.where(needed / safe_num_rel < level, needed + 1, needed)
+                needed = np.maximum(needed, 1).astype(np.int64)
+                reached = has_rel & (num_hits >= needed)
+                # Best precision at or after the rank where the level is reached:
+                # the highest precision of the relevant hits from that one on
+                first = np.where(reached, hit_starts[:-1] + needed - 1, hit_starts[:-1])
+                bounds = np.stack([first, hit_starts[1:]], axis=1).ravel()
+                best_after = np.maximum.reduceat(np.append(hit_precision, 0.0), bounds)[::2]
+                values = np.where(reached, best_after, 0.0)
+            elif match and match.group(1) == "P":
+                cutoff = int(match.group(2))
+                values = relevant_at(cutoff) / cutoff
+            elif match and match.group(1) == "recall":
+                values = relevant_at(int(match.group(2))) / safe_num_rel
+            elif match and match.group(1) == "ndcg_cut":
+                cutoff = int(match.group(2))
+                discounts = 1.0 / np.log2(np.arange(2, cutoff + 2))
+                gains = np.nan_to_num(np.maximum(labels[:, :cutoff], 0.0))
+                dcg = gains @ discounts[: gains.shape[1]]
+                ideal = self.ideal_gains[query_rows, :cutoff]
+                ideal_dcg = ideal @ discounts[: ideal.shape[1]]
+                values = np.where(ideal_dcg > 0, dcg / np.where(ideal_dcg > 0, ideal_dcg, 1), 0.0)
+            else:
+                raise ValueError(f"Unsupported metric {metric!r}")
+            results[metric] = np.where(has_rel, values, 0.0)
+        return query_ids, results
+
+
+def per_query(query_ids, results):
+    # The {query_id: {metric: value}} layout of pytrec_eval's evaluate
+    columns = [values.tolist() for values in results.values()]
+    return {query_id: dict(zip(results, row)) for query_id, row in zip(query_ids, zip(*columns))}
+
+
+def mean_metrics(results):
+    return {metric: float(values.mean()) if len(values) else 0.0 for metric, values in results.items()}
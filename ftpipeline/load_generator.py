@@ -0,0 +1,105 @@
+"""Load generator for search_server.py.
+
+Keeps concurrency connections busy with POST /search requests for the test
+queries for duration seconds, then prints the client-side QPS and latency
+percentiles next to the server's own /stats.
+
+Usage: python load_generator.py [port | unix socket path] [concurrency] [duration] [top_k]
+"""
+
+import asyncio
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from loaders import load_tsv
+
+data_folder = 'msmarco-data'
+host = '127.0.0.1'
+
+
+async def open_connection(address):
+    if isinstance(address, str):
+        return await asyncio.open_unix_connection(address)
+    return await asyncio.open_connection(host, address)
+
+
+async def request(reader, writer, method, path, payload=None):
+    # Sends one keep-alive request and returns (status code, JSON response)
+    body = json.dumps(payload).encode('utf-8') if payload is not None else b''
+    writer.write(
+        (
+            f"{method} {path} HTTP/1.1\r\n"
+            f"Host: {host}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n"
+        ).encode('latin-1')
+        + body
+    )
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return status, json.loads(await reader.readexactly(int(headers['content-length'])))
+
+
+async def client(address, queries, offset, top_k, stop_time, latencies, failures):
+    reader, writer = await open_connection(address)
+    try:
+        row = offset
+        while time.perf_counter() < stop_time:
+            start_time = time.perf_counter()
+            status, _ = await request(
+                reader, writer, 'POST', '/search', {'query': queries[row % len(queries)], 'top_k': top_k}
+            )
+            if status == 200:
+                latencies.append(time.perf_counter() - start_time)
+            else:
+                failures.append(status)
+            row += 1
+    finally:
+        writer.close()
+
+
+async def main(address, concurrency, duration, top_k):
+    queries, _ = load_tsv(os.path.join(data_folder, 'queries.test.tsv'))
+    queries = list(queries.values())
+    latencies = []
+    failures = []
+    start_time = time.perf_counter()
+    stop_time = start_time + duration
+    await asyncio.gather(
+        *(
+            client(address, queries, offset * 7919, top_k, stop_time, latencies, failures)
+            for offset in range(concurrency)
+        )
+    )
+    elapsed = time.perf_counter() - start_time
+
+    reader, writer = await open_connection(address)
+    _, server_stats = await request(reader, writer, 'GET', '/stats')
+    writer.close()
+
+    print(f"\n{concurrency} connections for {elapsed:.1f} s, top {top_k}")
+    print(f"Requests: {len(latencies)} ok, {len(failures)} failed")
+    print(f"Client QPS: {len(latencies) / elapsed:.1f}")
+    if latencies:
+        p50, p95, p99 = np.percentile(np.asarray(latencies) * 1000, [50, 95, 99])
+        print(f"Client latency ms: p50 {p50:.2f}  p95 {p95:.2f}  p99 {p99:.2f}")
+    print(f"Server stats: {json.dumps(server_stats)}")
+
+
+if __name__ == '__main__':
+    address = sys.argv[1] if len(sys.argv) > 1 else '8000'
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    duration = float(sys.argv[3]) if len(sys.argv) > 3 else 10.0
+    top_k = int(sys.argv[4]) if len(sys.argv) > 4 else 10
+    asyncio.run(main(int(address) if address.isdigit() else address, concurrency, duration, top_k))
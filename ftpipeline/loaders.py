@@ -0,0 +1,281 @@
+import json
+import mmap
+import os
+import shutil
+from collections.abc import Mapping
+from operator import itemgetter, methodcaller
+
+import numpy as np
+from tqdm import tqdm
+
+# orjson parses the hard negatives several times faster when it is installed
+try:
+    import orjson
+
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+CHUNK_SIZE = 1 << 24
+
+
+def is_stripped(lines):
+    # No line is empty or starts or ends with whitespace, so a block of
+    # such lines can be parsed in bulk instead of line by line
+    return all(lines) and list(map(str.strip, lines)) == lines
+
+
+def iter_chunks(path, desc=None, chunk_size=CHUNK_SIZE):
+    """
+    Reads path in one pass as (file offset, bytes) blocks of whole lines,
+    each ending with a newline (but the last if the file does not). The
+    tqdm bar counts bytes, so its total comes from the file size instead of
+    a first pass counting lines.
+    """
+    with open(path, "rb") as f, tqdm(
+        total=os.path.getsize(path),
+        unit="B",
+        unit_scale=True,
+        unit_divisor=1024,
+        desc=desc,
+        disable=desc is None,
+    ) as progress:
+        offset = 0
+        tail = b""
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            progress.update(len(chunk))
+            buffer = tail + chunk
+            end = buffer.rfind(b"\n") + 1
+            tail = buffer[end:]
+            if end:
+                yield offset, buffer[:end]
+                offset += end
+        if tail:
+            yield offset, tail + b"\n"
+
+
+def iter_lines(path, desc=None):
+    # Decoded lines without their newline, a chunk at a time
+    for _, block in iter_chunks(path, desc):
+        yield from block.decode("utf-8")[:-1].split("\n")
+
+
+def load_tsv(path, desc=None):
+    """
+    Reads a two-column TSV (collection.tsv, queries.*.tsv) into an {id: text}
+    dict in file order, skipping empty lines. Lines without exactly two
+    non-empty fields after stripping are returned rather than printed, so
+    callers can report them.
+
+    Returns:
+        (dict, [(line number, line) of the malformed lines])
+    """
+    texts = {}
+    malformed = []
+    line_num = 0
+    for _, block in iter_chunks(path, desc):
+        text = block.decode("utf-8")[:-1]
+        lines = text.split("\n")
+        if is_stripped(lines):
+            try:
+                # Raises on a line without exactly one tab; the entries already
+                # added are set again, in the same order, by the loop below
+                texts.update(map(methodcaller("split", "\t"), lines))
+                line_num += len(lines)
+                continue
+            except ValueError:
+                pass
+        for line in lines:
+            line_num += 1
+            line = line.strip()
+            if not line:
+                continue
+            fields = line.split("\t")
+            if len(fields) == 2 and fields[0] and fields[1]:
+                texts[fields[0]] = fields[1]
+            else:
+                malformed.append((line_num, line))
+    return texts, malformed
+
+
+def iter_jsonl(path, desc=None):
+    # Parsed objects of a JSON lines file, decoded straight from the bytes
+    for _, block in iter_chunks(path, desc):
+        for line in block.split(b"\n"):
+            if line.strip():
+                yield json_loads(line)
+
+
+class LazyCorpus(Mapping):
+    """
+    Read-only {pid: passage} over a memory-mapped two-column TSV.
+
+    Passages stay in the file and are sliced out of the mapping on access,
+    so memory does not grow with the corpus and DataLoader workers share
+    the pages through the page cache. Lookups go through a compact sorted
+    index (pids as fixed-width bytes, with the byte offset and length of
+    every passage) that is built once, saved next to the file and
+    memory-mapped on later runs, until the file changes.
+
+    Valid lines, their order and the passages are the same as with
+    load_tsv; malformed holds the skipped lines. Datasets can resolve pids
+    to integer rows once with rows() and read them with passage(row).
+    """
+
+    INDEX_FILES = ("sorted_pids", "sorted_rows", "file_order", "offsets", "lengths")
+
+    def __init__(self, path, desc=None, index_dir=None):
+        self.path = path
+        self.index_dir = index_dir or f"{path}.index"
+        stat = os.stat(path)
+        self.meta = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        if load_json(os.path.join(self.index_dir, "meta.json")) != self.meta:
+            print(f"Indexing {path} into {self.index_dir}")
+            write_corpus_index(path, self.index_dir, self.meta, desc)
+        self.open()
+
+    def open(self):
+        for name in self.INDEX_FILES:
+            array = np.load(os.path.join(self.index_dir, f"{name}.npy"), mmap_mode="r")
+            setattr(self, name, array)
+        malformed = load_json(os.path.join(self.index_dir, "malformed.json"))
+        self.malformed = [tuple(line) for line in malformed]
+        with open(self.path, "rb") as f:
+            # mmap cannot map an empty file
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.meta["size"] else b""
+
+    def rows(self, pids):
+        """
+        Returns the rows of pids for passage(), -1 for pids not in the corpus.
+        """
+        encoded = [pid.encode("utf-8") for pid in pids]
+        if not len(self.sorted_pids):
+            return np.full(len(encoded), -1, dtype=np.int64)
+        keys = np.array(encoded, dtype=self.sorted_pids.dtype)
+        positions = np.minimum(np.searchsorted(self.sorted_pids, keys), len(self.sorted_pids) - 1)
+        found = self.sorted_pids[positions] == keys
+        # The dtype truncates pids longer than any in the corpus, which then must not match
+        found &= np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded)) <= keys.itemsize
+        return np.where(found, self.sorted_rows[positions], -1)
+
+    def passage(self, row):
+        start = int(self.offsets[row])
+        return self.data[start : start + int(self.lengths[row])].decode("utf-8")
+
+    def __getitem__(self, pid):
+        row = self.rows([pid])[0]
+        if row < 0:
+            raise KeyError(pid)
+        return self.passage(row)
+
+    def __contains__(self, pid):
+        return isinstance(pid, str) and self.rows([pid])[0] >= 0
+
+    def __iter__(self):
+        for position in self.file_order:
+            yield self.sorted_pids[position].decode("utf-8")
+
+    def __len__(self):
+        return len(self.sorted_pids)
+
+    def __getstate__(self):
+        # Workers started with spawn map the files again instead of receiving copies
+        return {"path": self.path, "index_dir": self.index_dir, "meta": self.meta}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.open()
+
+
+def load_json(path):
+    if not os.path.isfile(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def write_corpus_index(path, index_dir, meta, desc=None):
+    """
+    Scans a two-column TSV once and writes the LazyCorpus index of it into
+    index_dir. A pid that occurs twice keeps its first position in the
+    iteration order and the passage of its last line, like a dict would.
+    """
+    pids = []
+    offsets = []
+    lengths = []
+    malformed = []
+    line_num = 0
+    for block_offset, block in iter_chunks(path, desc):
+        lines = block.decode("utf-8")[:-1].split("\n")
+        if is_stripped(lines):
+            data = np.frombuffer(block, dtype=np.uint8)
+            newlines = np.flatnonzero(data == ord("\n"))
+            tabs = np.flatnonzero(data == ord("\t"))
+            # Exactly one tab per line: the passage runs from it to the newline
+            if len(tabs) == len(newlines) and np.array_equal(
+                np.searchsorted(newlines, tabs), np.arange(len(tabs))
+            ):
+                raw_lines = block[:-1].split(b"\n")
+                pids.extend(map(itemgetter(0), map(methodcaller("split", b"\t", 1), raw_lines)))
+                offsets.append(block_offset + tabs + 1)
+                lengths.append(newlines - tabs - 1)
+                line_num += len(newlines)
+                continue
+
+        block_offsets = []
+        block_lengths = []
+        line_offset = block_offset
+        for raw_line, line in zip(block[:-1].split(b"\n"), lines):
+            line_num += 1
+            # Parsed like load_tsv, on str so non-ASCII whitespace strips the same
+            fields = line.strip().split("\t")
+            if len(fields) == 2 and fields[0] and fields[1]:
+                prefix = line[: len(line) - len(line.lstrip()) + len(fields[0]) + 1]
+                pid = fields[0].encode("utf-8")
+                if raw_line.isascii():
+                    prefix_length, passage_length = len(prefix), len(fields[1])
+                else:
+                    prefix_length = len(prefix.encode("utf-8"))
+                    passage_length = len(fields[1].encode("utf-8"))
+                pids.append(pid)
+                block_offsets.append(line_offset + prefix_length)
+                block_lengths.append(passage_length)
+            elif line.strip():
+                malformed.append((line_num, line.strip()))
+            line_offset += len(raw_line) + 1
+        offsets.append(np.asarray(block_offsets, dtype=np.int64))
+        lengths.append(np.asarray(block_lengths, dtype=np.int64))
+
+    pids = np.array(pids, dtype=f"S{max(map(len, pids), default=1)}")
+    offsets = np.concatenate(offsets) if offsets else np.zeros(0, dtype=np.int64)
+    lengths = (np.concatenate(lengths) if lengths else np.zeros(0)).astype(np.int32)
+    order = np.argsort(pids, kind="stable")
+    sorted_pids = pids[order]
+    # Runs of equal pids; the stable sort keeps each run in file order
+    starts = np.flatnonzero(np.r_[True, sorted_pids[1:] != sorted_pids[:-1]])[: len(pids)]
+    ends = np.r_[starts[1:], len(pids)][: len(starts)] - 1
+    index = {
+        "sorted_pids": sorted_pids[starts],
+        # Line holding the passage of every sorted pid: its last occurrence
+        "sorted_rows": order[ends],
+        # Sorted positions in the order the pids first occur in the file
+        "file_order": np.argsort(order[starts], kind="stable"),
+        "offsets": offsets,
+        "lengths": lengths,
+    }
+
+    # Write into a temporary directory and rename, so readers never see half an index
+    tmp_dir = f"{index_dir}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    for name, array in index.items():
+        np.save(os.path.join(tmp_dir, f"{name}.npy"), array)
+    with open(os.path.join(tmp_dir, "malformed.json"), "w") as f:
+        json.dump(malformed, f)
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    shutil.rmtree(index_dir, ignore_errors=True)
+    os.replace(tmp_dir, index_dir)
@@ -1,14 +1,20 @@
+import os
 import pickle
 import random
+from docstore import DocumentStore, write_document_store
+from parse_cache import cached_num_docs, iter_cached_documents, update_parse_cache
 from parser import (
     filter_relevance_file,
-    parse_documents,
     parse_queries,
     parse_relevance,
 )
 
 data_path = "../data"
 doc_path = f"{data_path}/ft/all"
+docstore_path = f"{data_path}/docstore"
+parse_cache_path = f"{data_path}/parse_cache"
+# Number of processes used to parse the FT files (1 parses serially)
+num_workers = os.cpu_count() or 1
 query_paths = [
     f"{data_path}/query-relJudgments/q-topics-org-SET1.txt",
     f"{data_path}/query-relJudgments/q-topics-org-SET2.txt",
@@ -23,21 +29,48 @@ relevance_path = [
 
 
 def parsing_phase():
-    # Read the documents (doc_ids are used to check if a document is relevant)
-    docs, doc_ids = parse_documents(doc_path)
-    print(f"Total documents: {len(docs)}")
+    # Stream the documents to disk (doc_ids are used to check if a document is relevant)
+    print("\nParsing documents into the document store...")
+    # Only new or modified FT files are parsed, the rest come from the parse cache
+    shard_paths, corpus_changed = update_parse_cache(
+        doc_path, parse_cache_path, num_workers
+    )
+    store = None
+    if not corpus_changed and os.path.isfile(f"{docstore_path}/meta.json"):
+        store = DocumentStore(docstore_path)
+        # A store written from other shards than the cached ones is rebuilt
+        if len(store) != cached_num_docs(parse_cache_path):
+            print("Document store does not match the parse cache, rebuilding it")
+            store = None
+    if store is None:
+        doc_ids = write_document_store(
+            iter_cached_documents(shard_paths), docstore_path
+        )
+    else:
+        print("Corpus unchanged, reusing the document store")
+        doc_ids = store.doc_ids()
+    print(f"Total documents: {len(doc_ids)}")
 
     queries = parse_queries(query_paths)
     print(f"Total queries: {len(queries)}")
 
     # Read the relevance judgments and add them to the queries
-    parse_relevance(
+    relevance_stats = parse_relevance(
         relevance_path,
         queries,
         doc_ids,
     )
+    for file_stats in relevance_stats:
+        print(
+            f"{file_stats['file']}: {file_stats['relevant']} relevant, "
+            f"{file_stats['non_relevant']} non-relevant, "
+            f"{file_stats['unknown_doc']} unknown docs, "
+            f"{file_stats['unknown_query']} unknown queries, "
+            f"{file_stats['malformed']} malformed lines "
+            f"({file_stats['seconds']:.3f}s)"
+        )
 
-    return docs, doc_ids, queries
+    return doc_ids, queries
 
 
 def split_queries(queries, test_size=50, min_relevant_docs=5):
@@ -71,14 +104,11 @@ def split_queries(queries, test_size=50, min_relevant_docs=5):
     return train_queries, test_queries
 
 
-def save_data(docs, queries_train, queries_test):
-    # Save documents
-    print("\nSaving documents...")
-    with open(f"{data_path}/docs.pkl", "wb") as f:
-        pickle.dump(docs, f)
-    
+def save_data(doc_ids, queries_train, queries_test):
+    # Documents were already streamed to the document store during parsing
+
     # Save train queries
-    print("Saving train queries...")
+    print("\nSaving train queries...")
     with open(f"{data_path}/queriesTrainWithNonRelevant.pkl", "wb") as f:
         pickle.dump(queries_train, f)
     
@@ -88,17 +118,17 @@ def save_data(docs, queries_train, queries_test):
         pickle.dump(queries_test, f)
     
     print("\nAll data saved successfully!")
-    print(f"- Documents: {len(docs)} saved to docs.pkl")
+    print(f"- Documents: {len(doc_ids)} saved to {docstore_path}")
     print(f"- Train queries: {len(queries_train)} saved to queriesTrainWithNonRelevant.pkl")
     print(f"- Test queries: {len(queries_test)} saved to queriesTestWithNonRelevant.pkl")
 
 
 if __name__ == "__main__":
     # Parse all data
-    docs, doc_ids, queries = parsing_phase()
+    doc_ids, queries = parsing_phase()
 
     # Split queries into train and test sets
     queries_train, queries_test = split_queries(queries, test_size=50, min_relevant_docs=5)
 
     # Save all data
-    save_data(docs, queries_train, queries_test)
+    save_data(doc_ids, queries_train, queries_test)
@@ -0,0 +1,134 @@
+"""Hard-negative mining for msmarco-hard-negatives.jsonl.
+
+Searches every training query of msmarco-hard-negatives.jsonl in batches,
+either in the dense index persisted by evaluate.py (through
+search_server.SearchService, with the same settings) or with BM25, and
+writes its top num_negatives hits that are not positives of the query into
+its neg block under system_name, next to the systems already there.
+backbone.py trains on them with negs_to_use = system_name.
+
+Mined negatives get the placeholder ce-score 0.0 of the judged non-relevant
+documents of convert_to_msmarco.py, and the retrieval score is kept in
+score. They train with MultipleNegativesRankingLoss; backbone.py's
+MarginMSE needs them scored by a cross-encoder first.
+
+Usage: python mine_negatives.py [dense | bm25] [system name] [num negatives]
+"""
+
+import json
+import os
+import sys
+
+import numpy as np
+from tqdm import tqdm
+
+from loaders import iter_jsonl, load_tsv
+
+data_folder = 'msmarco-data'
+retriever = 'dense'  # 'dense' (index persisted by evaluate.py) or 'bm25'
+num_negatives = 50  # Negatives written per query
+batch_size = 256  # Queries searched together
+bm25_k1 = 0.9
+bm25_b = 0.4
+
+
+class BM25:
+    """
+    Okapi BM25 over a sparse document-term matrix, with the same search
+    interface as SearchService. The term weights of every document are
+    computed once, so a batch of queries is scored with one sparse product.
+    """
+
+    def __init__(self, doc_ids, texts, k1=bm25_k1, b=bm25_b):
+        # Imported here so dense mining does not need scikit-learn
+        from sklearn.feature_extraction.text import CountVectorizer
+
+        self.doc_ids = np.asarray(doc_ids, dtype=object)
+        self.vectorizer = CountVectorizer(dtype=np.float32)
+        term_freqs = self.vectorizer.fit_transform(texts).tocsr()  # (documents, terms)
+        lengths = np.asarray(term_freqs.sum(axis=1)).ravel()
+        doc_freqs = np.bincount(term_freqs.indices, minlength=term_freqs.shape[1])
+        idf = np.log1p((len(lengths) - doc_freqs + 0.5) / (doc_freqs + 0.5)).astype(np.float32)
+        length_norms = k1 * (1 - b + b * lengths / max(lengths.mean(), 1.0))
+        norms = np.repeat(length_norms, np.diff(term_freqs.indptr)).astype(np.float32)
+        term_freqs.data = term_freqs.data * (k1 + 1) / (term_freqs.data + norms) * idf[term_freqs.indices]
+        self.weights = term_freqs.T.tocsr()  # (terms, documents)
+
+    def search(self, texts, top_ks):
+        # [(doc_no, score)] of every text, top_ks[row] hits long at most;
+        # documents without a query term are not hits
+        scores = (self.vectorizer.transform(texts) @ self.weights).toarray()
+        k = min(max(top_ks), scores.shape[1])
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        hits = []
+        for row_scores, row_top, row_k in zip(scores, top, top_ks):
+            row_top = row_top[np.argsort(-row_scores[row_top], kind='stable')][:row_k]
+            row_top = row_top[row_scores[row_top] > 0]
+            hits.append(list(zip(self.doc_ids[row_top].tolist(), row_scores[row_top].tolist())))
+        return hits
+
+
+def load_searcher(name):
+    if name == 'dense':
+        # Imported here so BM25 mining needs neither torch nor faiss
+        from search_server import SearchService
+
+        return SearchService()
+    if name == 'bm25':
+        corpus, _ = load_tsv(os.path.join(data_folder, 'collection.tsv'), desc="Reading documents")
+        print("Indexing documents for BM25...")
+        return BM25(list(corpus.keys()), list(corpus.values()))
+    raise ValueError(f"Unknown retriever {name!r}, expected 'dense' or 'bm25'")
+
+
+def mine(searcher, entries, queries, count=num_negatives):
+    """
+    Returns {qid: [{'pid', 'ce-score', 'score'}]} with the top count hits
+    of every entry's query that are not its positives.
+    """
+    qids = [entry['qid'] for entry in entries if entry['qid'] in queries]
+    positives = {entry['qid']: {item['pid'] for item in entry['pos']} for entry in entries}
+    negatives = {}
+    for i in tqdm(range(0, len(qids), batch_size), desc="Mining negatives"):
+        batch = qids[i:i + batch_size]
+        # Positives can take some of the top places, so ask for that many more hits
+        top_ks = [count + len(positives[qid]) for qid in batch]
+        for qid, hits in zip(batch, searcher.search([queries[qid] for qid in batch], top_ks)):
+            negatives[qid] = [
+                {'pid': pid, 'ce-score': 0.0, 'score': score}
+                for pid, score in hits
+                if pid not in positives[qid]
+            ][:count]
+    return negatives
+
+
+def main(name, system_name, count):
+    train_filepath = os.path.join(data_folder, 'msmarco-hard-negatives.jsonl')
+    entries = list(iter_jsonl(train_filepath, desc="Reading training data"))
+    queries, _ = load_tsv(os.path.join(data_folder, 'queries.train.tsv'), desc="Reading queries")
+    missing = sum(entry['qid'] not in queries for entry in entries)
+    if missing:
+        print(f"Warning: {missing} training queries are not in queries.train.tsv and are not mined")
+
+    negatives = mine(load_searcher(name), entries, queries, count)
+
+    # Write to a temporary file and rename, so the training data is never left half written
+    with open(f"{train_filepath}.tmp", 'w', encoding='utf8') as f:
+        for entry in entries:
+            if entry['qid'] in negatives:
+                entry['neg'][system_name] = negatives[entry['qid']]
+            f.write(json.dumps(entry) + '\n')
+    os.replace(f"{train_filepath}.tmp", train_filepath)
+
+    counts = [len(query_negatives) for query_negatives in negatives.values()]
+    print(f"\nWrote {sum(counts)} negatives of {len(counts)} queries under '{system_name}' "
+          f"to {train_filepath}")
+    if counts:
+        print(f"Negatives per query: min {min(counts)}, mean {np.mean(counts):.1f}, max {max(counts)}")
+
+
+if __name__ == '__main__':
+    name = sys.argv[1] if len(sys.argv) > 1 else retriever
+    system_name = sys.argv[2] if len(sys.argv) > 2 else f'{name}-mined'
+    count = int(sys.argv[3]) if len(sys.argv) > 3 else num_negatives
+    main(name, system_name, count)
@@ -0,0 +1,125 @@
+import hashlib
+import json
+import multiprocessing
+import os
+
+from parser import dump_documents, iter_pickled_documents, parse_file
+
+MANIFEST_NAME = "manifest.json"
+
+
+def file_hash(file_path, chunk_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def parse_and_hash(file_path):
+    return file_hash(file_path), parse_file(file_path)
+
+
+def load_manifest(cache_dir):
+    manifest_path = os.path.join(cache_dir, MANIFEST_NAME)
+    if not os.path.isfile(manifest_path):
+        return {}
+    with open(manifest_path, "r") as f:
+        return json.load(f)
+
+
+def save_manifest(cache_dir, manifest):
+    # Replace the manifest atomically so an interrupted run never leaves it half written
+    manifest_path = os.path.join(cache_dir, MANIFEST_NAME)
+    with open(f"{manifest_path}.tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+
+
+def update_parse_cache(directory_path, cache_dir, num_workers=1):
+    """
+    Parses only the FT files that are new or changed since the last run.
+
+    Every file is cached as its own stream of pickled Documents, keyed by
+    path, mtime/size and a SHA-1 of its content. A file whose mtime changed
+    but whose content did not is not parsed again.
+
+    Returns:
+        (shard_paths, changed): the cached shard of every file in directory
+        order, and whether any file was added, modified or removed
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    manifest = load_manifest(cache_dir)
+
+    file_names = [
+        file_name
+        for file_name in os.listdir(directory_path)
+        if os.path.isfile(os.path.join(directory_path, file_name))
+    ]
+    entries = {}
+    stale = []
+    for file_name in file_names:
+        file_path = os.path.join(directory_path, file_name)
+        stat = os.stat(file_path)
+        entry = manifest.get(file_name)
+        if entry is None or not os.path.isfile(os.path.join(cache_dir, entry["shard"])):
+            stale.append(file_name)
+            continue
+        if entry["mtime_ns"] != stat.st_mtime_ns or entry["size"] != stat.st_size:
+            if entry["sha1"] != file_hash(file_path):
+                stale.append(file_name)
+                continue
+            entry = dict(entry, mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+        entries[file_name] = entry
+
+    if stale:
+        print(f"Parsing {len(stale)} new or modified files ({len(entries)} cached)")
+        stale_paths = [os.path.join(directory_path, file_name) for file_name in stale]
+        if num_workers > 1 and len(stale) > 1:
+            pool = multiprocessing.Pool(min(num_workers, len(stale)))
+            results = pool.imap(parse_and_hash, stale_paths)
+        else:
+            pool = None
+            results = map(parse_and_hash, stale_paths)
+        try:
+            for file_name, file_path, (digest, documents) in zip(
+                stale, stale_paths, results
+            ):
+                shard = f"{file_name}.pkl"
+                dump_documents(documents, os.path.join(cache_dir, shard))
+                stat = os.stat(file_path)
+                entries[file_name] = {
+                    "shard": shard,
+                    "mtime_ns": stat.st_mtime_ns,
+                    "size": stat.st_size,
+                    "sha1": digest,
+                    "num_docs": len(documents),
+                }
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    # Drop the shards of files that no longer exist
+    removed = [file_name for file_name in manifest if file_name not in entries]
+    for file_name in removed:
+        shard_path = os.path.join(cache_dir, manifest[file_name]["shard"])
+        if os.path.isfile(shard_path):
+            os.remove(shard_path)
+
+    changed = bool(stale or removed) or list(manifest) != file_names
+    if changed or entries != manifest:
+        save_manifest(cache_dir, {file_name: entries[file_name] for file_name in file_names})
+
+    shard_paths = [os.path.join(cache_dir, entries[file_name]["shard"]) for file_name in file_names]
+    return shard_paths, changed
+
+
+def cached_num_docs(cache_dir):
+    # Documents in all cached shards, as recorded in the manifest
+    return sum(entry["num_docs"] for entry in load_manifest(cache_dir).values())
+
+
+def iter_cached_documents(shard_paths):
+    for shard_path in shard_paths:
+        yield from iter_pickled_documents(shard_path)
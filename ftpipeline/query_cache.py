@@ -0,0 +1,174 @@
+import collections
+import hashlib
+import json
+import os
+import pickle
+
+import numpy as np
+
+
+def fingerprint(value):
+    # Stable hash of a JSON-serializable value (dict keys sorted)
+    return hashlib.sha1(json.dumps(value, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class LRUCache:
+    """
+    Size-bounded LRU mapping with hit/miss counters.
+
+    With disk_dir, entries are also pickled there (one file per key) and an
+    entry evicted from memory is still found on disk, across processes and
+    runs. The disk tier keeps at most max_disk_entries files, dropping the
+    least recently used by mtime, which is refreshed on every disk hit.
+    """
+
+    def __init__(self, max_entries=100000, disk_dir=None, max_disk_entries=1000000):
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self.max_disk_entries = max_disk_entries
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.num_disk_entries = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self.num_disk_entries = sum(name.endswith(".pkl") for name in os.listdir(disk_dir))
+
+    def disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{fingerprint(key)}.pkl")
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        if self.disk_dir:
+            path = self.disk_path(key)
+            try:
+                with open(path, "rb") as f:
+                    value = pickle.load(f)
+                os.utime(path)
+            except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+                value = None
+            if value is not None:
+                self.disk_hits += 1
+                self.put(key, value, write_through=False)
+                return value
+        self.misses += 1
+        return None
+
+    def put(self, key, value, write_through=True):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        if self.disk_dir and write_through:
+            path = self.disk_path(key)
+            if not os.path.exists(path):
+                self.num_disk_entries += 1
+            # Write to a temporary file and rename, so readers never see half an entry
+            with open(f"{path}.tmp", "wb") as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(f"{path}.tmp", path)
+            if self.num_disk_entries > self.max_disk_entries:
+                self.trim_disk()
+
+    def trim_disk(self):
+        # Drop the least recently used tenth beyond the limit at once, so
+        # the directory is not listed on every insert
+        paths = [
+            os.path.join(self.disk_dir, name)
+            for name in os.listdir(self.disk_dir)
+            if name.endswith(".pkl")
+        ]
+        paths.sort(key=os.path.getmtime)
+        excess = len(paths) - int(self.max_disk_entries * 0.9)
+        for path in paths[: max(excess, 0)]:
+            os.remove(path)
+        self.num_disk_entries = len(paths) - max(excess, 0)
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "disk_entries": self.num_disk_entries,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+        }
+
+
+class QueryCache:
+    """
+    Two-level cache in front of a dense retriever.
+
+    Level 1 maps (model key, query text) to the query embedding, level 2 maps
+    (index key, embedding hash, k) to the top-k (scores, indices). The model
+    key must change with anything that changes embeddings (weights,
+    precision, max length...) and the index key with anything that changes
+    results (documents, index type and parameters, search parameters), so
+    stale entries are never returned. Without an index key, results are not
+    cached.
+    """
+
+    def __init__(
+        self,
+        model_key,
+        index_key=None,
+        max_embeddings=100000,
+        max_results=10000,
+        disk_dir=None,
+    ):
+        self.model_key = model_key
+        self.index_key = index_key
+        self.embeddings = LRUCache(
+            max_embeddings, disk_dir and os.path.join(disk_dir, "embeddings")
+        )
+        self.results = LRUCache(max_results, disk_dir and os.path.join(disk_dir, "results"))
+
+    def encode(self, texts, encode_fn):
+        """
+        Returns the (len(texts), dim) embeddings of texts; encode_fn(texts)
+        only runs on the texts that are not cached.
+        """
+        cached = [self.embeddings.get((self.model_key, text)) for text in texts]
+        missing = [row for row, embedding in enumerate(cached) if embedding is None]
+        if missing:
+            encoded = encode_fn([texts[row] for row in missing])
+            for row, embedding in zip(missing, encoded):
+                cached[row] = np.array(embedding, dtype=np.float32)
+                self.embeddings.put((self.model_key, texts[row]), cached[row])
+        return np.stack(cached) if cached else np.empty((0, 0), dtype=np.float32)
+
+    def search(self, embeddings, top_ks, search_fn):
+        """
+        Returns one (scores, indices) pair per row of embeddings, top_ks[row]
+        hits long. search_fn(embeddings, k) has the faiss Index.search
+        signature and only runs on the rows that are not cached, with their
+        largest k.
+        """
+        if self.index_key is None:
+            scores, indices = search_fn(embeddings, max(top_ks))
+            return [(scores[row, :k], indices[row, :k]) for row, k in enumerate(top_ks)]
+
+        keys = [
+            (self.index_key, hashlib.sha1(np.ascontiguousarray(embedding).tobytes()).hexdigest(), k)
+            for embedding, k in zip(embeddings, top_ks)
+        ]
+        cached = [self.results.get(key) for key in keys]
+        missing = [row for row, result in enumerate(cached) if result is None]
+        if missing:
+            scores, indices = search_fn(embeddings[missing], max(top_ks[row] for row in missing))
+            for position, row in enumerate(missing):
+                k = top_ks[row]
+                cached[row] = (scores[position, :k].copy(), indices[position, :k].copy())
+                self.results.put(keys[row], cached[row])
+        return cached
+
+    def stats(self):
+        return {"embeddings": self.embeddings.stats(), "results": self.results.stats()}
@@ -0,0 +1,340 @@
+"""Long-lived local search service over the index persisted by evaluate.py.
+
+Loads the model and memory-maps the FAISS index once, then answers HTTP
+requests over TCP or a Unix socket:
+
+    POST /search  {"query": "...", "top_k": 10}
+        -> {"hits": [{"doc_no": "...", "score": 12.3}, ...], "latency_ms": 4.2}
+    GET /stats
+        -> request count, QPS, p50/p95/p99 latency, mean batch size and
+           query cache hits/misses
+
+Concurrent queries are micro-batched: the first query of a batch waits at
+most max_wait_ms for others to arrive (or until max_batch_size), then the
+whole batch goes through one forward pass and one index.search. Queries that
+arrive while a batch runs form the next one. Queries seen before are
+answered from the query cache (query_cache.py) without encoding or search.
+
+Usage: python search_server.py [port | unix socket path]
+"""
+
+import asyncio
+import collections
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from sentence_transformers import SentenceTransformer
+from sentence_transformers.util import batch_to_device
+
+from ann_index import index_file_name, index_manifest, load_valid_index, set_search_params
+from inference import model_fingerprint, prepare_model
+from loaders import LazyCorpus
+from query_cache import QueryCache, fingerprint
+
+# Same settings as evaluate.py, which builds and persists the index
+model_path = '/kaggle/working/train_bi-encoder-margin_mse_en-custom_bert_dot_v5-sentence-transformers-msmarco-bert-base-dot-v5-batch_size_8-2025-01-15_15-47-06'
+data_folder = 'msmarco-data'
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+precision = 'fp32'
+index_type = 'flat'
+index_params = {}
+search_params = {}
+index_dir = os.path.join(data_folder, 'faiss_index')
+
+host = '127.0.0.1'
+port = 8000
+max_batch_size = 64  # Queries encoded and searched together
+max_wait_ms = 5.0  # Longest a query waits for a batch to fill
+max_top_k = 1000
+stats_window = 10000  # Latencies kept for the percentiles
+qps_window_seconds = 10.0
+# Repeated queries are answered from the query cache without encoding or search
+max_cached_embeddings = 100000
+max_cached_results = 10000
+query_cache_dir = None  # e.g. os.path.join(data_folder, 'query_cache') to share evaluate.py's cache
+
+
+def pooling_mode(model):
+    for module in model:
+        if hasattr(module, 'pooling_mode'):
+            return module.pooling_mode
+        if hasattr(module, 'get_pooling_mode_str'):
+            return module.get_pooling_mode_str()
+    return None
+
+
+class LatencyStats:
+    """
+    Request latencies and throughput of the server. Percentiles cover the
+    last stats_window requests, QPS the last qps_window_seconds.
+    """
+
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.latencies = collections.deque(maxlen=stats_window)
+        self.completed_at = collections.deque()
+        self.num_requests = 0
+        self.num_errors = 0
+        self.num_batches = 0
+
+    def record_batch(self, latencies):
+        now = time.perf_counter()
+        self.num_batches += 1
+        self.num_requests += len(latencies)
+        self.latencies.extend(latencies)
+        self.completed_at.extend([now] * len(latencies))
+
+    def snapshot(self):
+        now = time.perf_counter()
+        while self.completed_at and now - self.completed_at[0] > qps_window_seconds:
+            self.completed_at.popleft()
+        window = min(qps_window_seconds, now - self.start_time)
+        stats = {
+            'requests': self.num_requests,
+            'errors': self.num_errors,
+            'uptime_s': round(now - self.start_time, 1),
+            'qps': round(len(self.completed_at) / window, 1) if window > 0 else 0.0,
+            'mean_batch_size': round(self.num_requests / max(self.num_batches, 1), 2),
+        }
+        if self.latencies:
+            p50, p95, p99 = np.percentile(np.asarray(self.latencies) * 1000, [50, 95, 99])
+            stats.update(p50_ms=round(p50, 2), p95_ms=round(p95, 2), p99_ms=round(p99, 2))
+        return stats
+
+
+class SearchService:
+    """
+    Encodes query batches and searches them in the persisted index.
+    """
+
+    def __init__(self):
+        print("Loading model...")
+        self.model = SentenceTransformer(model_path)
+        self.model.to(device)
+        self.model.eval()
+        self.encoder = prepare_model(self.model, precision)
+
+        # Document ids in index order; LazyCorpus skips the same lines as evaluate.py
+        # without keeping the passages
+        collection = LazyCorpus(os.path.join(data_folder, 'collection.tsv'), desc="Reading document ids")
+        self.doc_ids = np.asarray(list(collection), dtype=object)
+        # Only an index built from this model and these documents is used
+        model_hash = model_fingerprint(model_path)
+        expected_manifest = index_manifest(
+            index_type,
+            index_params,
+            any(type(module).__name__ == 'Normalize' for module in self.model),
+            len(self.doc_ids),
+            model_hash=model_hash,
+            pooling=pooling_mode(self.model),
+            precision=precision,
+            max_seq_length=self.model.max_seq_length,
+            ids_sha1=hashlib.sha1('\n'.join(self.doc_ids).encode('utf-8')).hexdigest(),
+        )
+        # evaluate.py names the index after its manifest
+        index_path = os.path.join(index_dir, index_file_name(expected_manifest))
+        self.index = load_valid_index(index_path, expected_manifest)
+        if self.index is None:
+            raise FileNotFoundError(
+                f"No index for this model and collection at {index_path}, run evaluate.py first"
+            )
+        set_search_params(self.index, **search_params)
+        print(f"Memory-mapped {index_path} ({self.index.ntotal} documents)")
+
+        # Keyed like evaluate.py's query cache, so both can share query_cache_dir
+        self.cache = QueryCache(
+            fingerprint({
+                'model_hash': model_hash,
+                'pooling': pooling_mode(self.model),
+                'precision': precision,
+                'max_seq_length': self.model.max_seq_length,
+            }),
+            fingerprint({'index': expected_manifest, 'search_params': search_params}),
+            max_cached_embeddings,
+            max_cached_results,
+            query_cache_dir,
+        )
+
+    def encode(self, texts):
+        features = batch_to_device(self.model.tokenize(texts), device)
+        with torch.no_grad():
+            return self.encoder(features)['sentence_embedding'].float().cpu().numpy()
+
+    def search(self, texts, top_ks):
+        # One forward pass and one index.search for the queries of the batch that are not cached
+        embeddings = self.cache.encode(texts, self.encode)
+        hits = []
+        for row_scores, row_indices in self.cache.search(embeddings, top_ks, self.index.search):
+            found = row_indices >= 0
+            doc_nos = self.doc_ids[row_indices[found]].tolist()
+            hits.append(list(zip(doc_nos, row_scores[found].tolist())))
+        return hits
+
+
+class MicroBatcher:
+    """
+    Collects concurrent queries into batches for SearchService.search, which
+    runs in a worker thread so the event loop keeps accepting requests.
+    """
+
+    def __init__(self, service, stats):
+        self.service = service
+        self.stats = stats
+        self.queue = asyncio.Queue()
+        # Set on every submit. Waiting on it rather than on queue.get() means a
+        # timeout never swallows a query that was dequeued just as it fired
+        self.arrived = asyncio.Event()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    async def submit(self, text, top_k):
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((text, top_k, time.perf_counter(), future))
+        self.arrived.set()
+        return await future
+
+    async def wait_for_query(self, timeout=None):
+        # True once the queue holds a query, False if timeout passes first
+        while self.queue.empty():
+            self.arrived.clear()
+            try:
+                await asyncio.wait_for(self.arrived.wait(), timeout)
+            except asyncio.TimeoutError:
+                return not self.queue.empty()
+        return True
+
+    async def next_batch(self):
+        await self.wait_for_query()
+        batch = [self.queue.get_nowait()]
+        deadline = batch[0][2] + max_wait_ms / 1000
+        while len(batch) < max_batch_size:
+            # Queries that queued up while the previous batch ran join right away
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0 or not await self.wait_for_query(timeout):
+                break
+        return batch
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.next_batch()
+            texts = [text for text, _, _, _ in batch]
+            top_ks = [top_k for _, top_k, _, _ in batch]
+            try:
+                hits = await loop.run_in_executor(self.executor, self.service.search, texts, top_ks)
+            except Exception as error:
+                self.stats.num_errors += len(batch)
+                for _, _, _, future in batch:
+                    # The handler of a done future was cancelled (e.g. its client went away)
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            now = time.perf_counter()
+            self.stats.record_batch([now - enqueued_at for _, _, enqueued_at, _ in batch])
+            for (_, _, enqueued_at, future), query_hits in zip(batch, hits):
+                if not future.done():
+                    future.set_result((query_hits, now - enqueued_at))
+
+
+async def read_request(reader):
+    # (method, path, headers, body) of the next HTTP/1.1 request, None at EOF
+    request_line = await reader.readline()
+    if not request_line.strip():
+        return None
+    method, path, _ = request_line.decode('latin-1').split(' ', 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return method, path, headers, body
+
+
+def write_response(writer, status, payload, keep_alive):
+    body = json.dumps(payload).encode('utf-8')
+    writer.write(
+        (
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        ).encode('latin-1')
+        + body
+    )
+
+
+async def handle_request(batcher, stats, method, path, body):
+    # (status, payload) of one request
+    if method == 'GET' and path == '/stats':
+        return '200 OK', dict(stats.snapshot(), cache=batcher.service.cache.stats())
+    if method != 'POST' or path != '/search':
+        return '404 Not Found', {'error': f"Unknown endpoint {method} {path}"}
+    try:
+        request = json.loads(body)
+        query = request['query']
+        top_k = int(request.get('top_k', 10))
+        if not isinstance(query, str) or not 1 <= top_k <= max_top_k:
+            raise ValueError
+    except (ValueError, KeyError, TypeError):
+        return '400 Bad Request', {
+            'error': f'Expected {{"query": str, "top_k": 1..{max_top_k}}}'
+        }
+    try:
+        hits, latency = await batcher.submit(query, top_k)
+    except Exception as error:
+        return '500 Internal Server Error', {'error': repr(error)}
+    return '200 OK', {
+        'hits': [{'doc_no': doc_no, 'score': score} for doc_no, score in hits],
+        'latency_ms': round(latency * 1000, 3),
+    }
+
+
+async def serve(socket_address):
+    service = SearchService()
+    stats = LatencyStats()
+    batcher = MicroBatcher(service, stats)
+
+    async def handle_connection(reader, writer):
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                status, payload = await handle_request(batcher, stats, method, path, body)
+                write_response(writer, status, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    if isinstance(socket_address, str):
+        if os.path.exists(socket_address):
+            os.remove(socket_address)
+        server = await asyncio.start_unix_server(handle_connection, socket_address)
+        print(f"Serving on unix:{socket_address}")
+    else:
+        server = await asyncio.start_server(handle_connection, host, socket_address)
+        print(f"Serving on http://{host}:{socket_address}")
+    async with server:
+        await asyncio.gather(server.serve_forever(), batcher.run())
+
+
+if __name__ == '__main__':
+    address = sys.argv[1] if len(sys.argv) > 1 else str(port)
+    asyncio.run(serve(int(address) if address.isdigit() else address))
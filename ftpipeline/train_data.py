@@ -0,0 +1,134 @@
+import time
+
+import torch
+from torch.utils.data import DataLoader
+
+
+class TokenizingCollator:
+    """
+    Collates a batch of (texts, label) examples, texts being a (query, passage,
+    ...) tuple, into token ids in the (features, labels) format of
+    SentenceTransformer.smart_batching_collate: one padded features dict per
+    text column and a tensor of the labels.
+
+    Passed to a DataLoader with workers, tokenization runs in the worker
+    processes instead of the training loop. Texts are prepared like
+    SentenceTransformer.tokenize (stripped, lowercased for do_lower_case).
+    """
+
+    def __init__(self, tokenizer, max_seq_length, do_lower_case=False):
+        self.tokenizer = tokenizer
+        self.max_seq_length = max_seq_length
+        self.do_lower_case = do_lower_case
+
+    def __call__(self, batch):
+        examples, labels = zip(*batch)
+        features = []
+        for texts in zip(*examples):
+            texts = [text.strip() for text in texts]
+            if self.do_lower_case:
+                texts = [text.lower() for text in texts]
+            features.append(dict(self.tokenizer(
+                texts,
+                padding=True,
+                truncation='longest_first',
+                return_tensors='pt',
+                max_length=self.max_seq_length,
+            )))
+        return features, torch.tensor(labels)
+
+    @classmethod
+    def for_model(cls, model):
+        return cls(model.tokenizer, model.max_seq_length, getattr(model[0], 'do_lower_case', False))
+
+
+class StepTimer:
+    """
+    Splits the wall time of training steps into input time (waiting for the
+    next batch) and compute time (from receiving a batch until the next one
+    is requested: forward, backward and optimizer step). Prints both every
+    report_every steps and when the DataLoader runs out of batches.
+
+    Compute time is measured on the host, so it only covers the GPU work up
+    to the last synchronization in the step; with use_amp the grad scaler
+    synchronizes on every optimizer step.
+    """
+
+    def __init__(self, report_every=500):
+        self.report_every = report_every
+        self.reset()
+        self.total_steps = 0
+        self.total_input_time = 0.0
+        self.total_compute_time = 0.0
+
+    def reset(self):
+        self.steps = 0
+        self.input_time = 0.0
+        self.compute_time = 0.0
+
+    def record(self, input_time, compute_time):
+        self.steps += 1
+        self.input_time += input_time
+        self.compute_time += compute_time
+        self.total_steps += 1
+        self.total_input_time += input_time
+        self.total_compute_time += compute_time
+        if self.report_every and self.steps % self.report_every == 0:
+            self.report()
+
+    def report(self):
+        # Prints and resets the times since the last report
+        if not self.steps:
+            return
+        step_time = self.input_time + self.compute_time
+        print(
+            f"\nSteps {self.total_steps - self.steps + 1}-{self.total_steps}: "
+            f"input {self.input_time / self.steps * 1000:.1f} ms/step, "
+            f"compute {self.compute_time / self.steps * 1000:.1f} ms/step, "
+            f"{'input' if self.input_time > self.compute_time else 'compute'}-bound "
+            f"({self.input_time / step_time:.0%} of the step time waiting for input)"
+        )
+        self.reset()
+
+    def summary(self):
+        return {
+            'steps': self.total_steps,
+            'input_ms_per_step': self.total_input_time / max(self.total_steps, 1) * 1000,
+            'compute_ms_per_step': self.total_compute_time / max(self.total_steps, 1) * 1000,
+        }
+
+
+class PrefetchingDataLoader(DataLoader):
+    """
+    DataLoader that keeps its own collate_fn and times every step with a StepTimer.
+
+    SentenceTransformer.fit replaces the collate_fn of its DataLoaders with
+    smart_batching_collate, which tokenizes in the training loop; here the
+    assignment is ignored, so the batches stay tokenized by the workers.
+    """
+
+    def __init__(self, *args, timer=None, **kwargs):
+        self.timer = timer or StepTimer()
+        super().__init__(*args, **kwargs)
+
+    @property
+    def collate_fn(self):
+        return self._collate_fn
+
+    @collate_fn.setter
+    def collate_fn(self, collate_fn):
+        if not hasattr(self, '_collate_fn'):
+            self._collate_fn = collate_fn
+
+    def __iter__(self):
+        batches = super().__iter__()
+        while True:
+            start_time = time.perf_counter()
+            try:
+                batch = next(batches)
+            except StopIteration:
+                self.timer.report()
+                return
+            received_at = time.perf_counter()
+            yield batch
+            self.timer.record(received_at - start_time, time.perf_counter() - received_at)